@@ -236,6 +236,17 @@ def replay_persona_state(request, sim_code, step, persona_name):
     spatial = json.load(json_file)
   with open(memory + "/associative_memory/nodes.json") as json_file:  
     associative = json.load(json_file)
+  # Nodes not yet compacted into nodes.json are in the journal. A torn last
+  # record (from an interrupted write) ends the replay.
+  journal = memory + "/associative_memory/journal.jsonl"
+  if os.path.exists(journal):
+    with open(journal, encoding="utf-8") as json_file:
+      for line in json_file:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          break
+        associative.setdefault(record["node_id"], record)
   a_mem_event = []; a_mem_chat = []; a_mem_thought = []
   for count in range(len(associative.keys()), 0, -1): 
     node_id = f"node_{str(count)}"
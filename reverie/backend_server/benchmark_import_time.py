@@ -0,0 +1,79 @@
+"""
+File: benchmark_import_time.py
+Description: Measures how long it takes to import the backend modules, each
+in a fresh interpreter (so nothing is already cached in sys.modules), and
+lists the slowest imports below them (from python -X importtime).
+
+Usage (from reverie/backend_server):
+  python benchmark_import_time.py [runs] [module ...]
+"""
+import subprocess
+import statistics
+import sys
+
+default_modules = ["persona.prompt_template.gpt_structure",
+                   "persona.prompt_template.run_gpt_prompt",
+                   "persona.persona",
+                   "maze",
+                   "reverie"]
+
+timer = ("import time; start = time.perf_counter(); import {module}; "
+         "print(time.perf_counter() - start, file=sys.__stderr__)")
+
+
+def time_import(module, runs):
+  """
+  Imports <module> in <runs> fresh interpreters.
+
+  INPUT
+    module: The dotted module name.
+    runs: The number of interpreters to start.
+  OUTPUT
+    A list of import times in seconds.
+  """
+  times = []
+  for i in range(runs):
+    result = subprocess.run(
+      [sys.executable, "-c", "import sys; " + timer.format(module=module)],
+      capture_output=True, text=True)
+    if result.returncode:
+      raise RuntimeError(f"importing {module} failed:\n{result.stderr}")
+    times += [float(result.stderr.strip().splitlines()[-1])]
+  return times
+
+
+def slowest_imports(module, n=5):
+  """
+  Returns the <n> slowest imports made while importing <module> (not
+  counting <module> and its parent packages), as (cumulative microseconds,
+  imported module) pairs.
+  """
+  result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                           f"import {module}"],
+                          capture_output=True, text=True)
+  parts = module.split(".")
+  own = set(".".join(parts[:i]) for i in range(1, len(parts) + 1))
+  rows = []
+  for line in result.stderr.splitlines():
+    if not line.startswith("import time:") or "cumulative" in line:
+      continue
+    self_us, cumulative_us, name = line[len("import time:"):].split("|")
+    if name.strip() not in own:
+      rows += [(int(cumulative_us), name.strip())]
+  return sorted(rows, reverse=True)[:n]
+
+
+if __name__ == '__main__':
+  runs = 5
+  modules = default_modules
+  if len(sys.argv) > 1:
+    runs = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    modules = sys.argv[2:]
+
+  for module in modules:
+    times = time_import(module, runs)
+    print (f"{module}: median {statistics.median(times):.3f}s, "
+           f"min {min(times):.3f}s ({runs} runs)")
+    for cumulative_us, name in slowest_imports(module):
+      print (f"    {cumulative_us / 1e6:.3f}s  {name}")
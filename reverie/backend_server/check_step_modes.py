@@ -0,0 +1,188 @@
+"""
+File: check_step_modes.py
+Description: Checks that the "threads" step mode of ReverieServer produces
+the same simulation as the "serial" mode. The LLM and the embedding model
+are replaced by deterministic stubs, the same simulation is forked twice and
+run for a number of steps in each mode, and then the movement files (the
+execution triple and chat of every persona in every step) and the personas'
+associative memories are compared.
+
+The stub answers a ChatGPT-style prompt with the example output it contains,
+a prompt that ends in an open "{" (the location prompts) with one of the
+options listed in its last {...}, and any other prompt with a digit. Which
+option or digit is derived from the prompt's hash. The completion and
+embedding caches are turned off during the check, so that the stub responses
+never end up in them.
+
+Usage (from reverie/backend_server):
+  python check_step_modes.py [fork_sim_code] [steps]
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+
+import numpy
+
+from utils import *
+from persona.prompt_template import gpt_structure
+from reverie import ReverieServer
+
+default_fork_sim_code = "base_the_ville_isabella_maria_klaus"
+default_steps = 20
+seed = 0
+
+example_output = re.compile(r'Example output json:\n(\{"output": .*\})\s*$',
+                            re.DOTALL)
+option_groups = re.compile(r"\{([^{}]*)\}")
+
+
+def stub_response(prompt):
+  """
+  Returns the deterministic stub response to <prompt>.
+  """
+  match = example_output.search(prompt)
+  if match:
+    return match.group(1)
+  digest = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest(), 16)
+  if prompt.rstrip().endswith("{"):
+    groups = [group for group in option_groups.findall(prompt)
+              if group.strip()]
+    if groups:
+      options = [option.strip() for option in groups[-1].split(",")]
+      return options[digest % len(options)] + "}"
+  return str(digest % 9 + 1)
+
+
+async def stub_request_async(prompt, gpt_parameter=None):
+  return stub_response(prompt)
+
+
+class StubEmbedModel:
+  def encode(self, texts):
+    vectors = []
+    for text in texts:
+      digest = hashlib.sha1(text.encode("utf-8")).digest()
+      rng = numpy.random.RandomState(int.from_bytes(digest[:4], "little"))
+      vectors += [rng.standard_normal(384).astype(numpy.float32)]
+    return vectors
+
+
+def install_stubs():
+  gpt_structure.llm_cache_enabled = False
+  gpt_structure.embedding_cache_enabled = False
+  gpt_structure.ChatGPT_single_request_async = stub_request_async
+  gpt_structure.ChatGPT_request_async = stub_request_async
+  gpt_structure.GPT_request_async = stub_request_async
+  gpt_structure.get_embed_model = lambda: StubEmbedModel()
+
+
+def run_simulation(fork_sim_code, sim_code, step_mode, steps):
+  """
+  Forks <fork_sim_code> into <sim_code> and runs it for <steps> steps in
+  <step_mode>. The environment file of each next step puts the personas on
+  the tiles they moved to, as the frontend would.
+
+  OUTPUT
+    A (movements, memories) tuple. <movements> is the list of the movement
+    files of the steps that were run, and <memories> maps each persona to
+    the (node_id, created, description) of every node in its associative
+    memory.
+  """
+  sim_folder = f"{fs_storage}/{sim_code}"
+  if os.path.exists(sim_folder):
+    shutil.rmtree(sim_folder)
+
+  random.seed(seed)
+  rs = ReverieServer(fork_sim_code, sim_code)
+  rs.step_mode = step_mode
+  rs.server_sleep = 0
+
+  movements = []
+  for i in range(steps):
+    step = rs.step
+    rs.start_server(1)
+    move_file = f"{sim_folder}/movement/{step}.json"
+    if rs.step == step or not os.path.exists(move_file):
+      raise RuntimeError(f"{step_mode}: step {step} did not finish")
+    with open(move_file) as json_file:
+      movement = json.load(json_file)
+    movements += [movement]
+
+    new_env = dict()
+    for persona_name, persona_movement in movement["persona"].items():
+      x, y = persona_movement["movement"]
+      new_env[persona_name] = {"maze": rs.maze.maze_name, "x": x, "y": y}
+    with open(f"{sim_folder}/environment/{rs.step}.json", "w") as outfile:
+      outfile.write(json.dumps(new_env, indent=2))
+
+  memories = dict()
+  for persona_name, persona in rs.personas.items():
+    memories[persona_name] = [
+      (node.node_id, str(node.created), node.description)
+      for node in (persona.a_mem.id_to_node[f"node_{count}"]
+                   for count in range(1, len(persona.a_mem.id_to_node) + 1))]
+  if rs.step_executor:
+    rs.step_executor.shutdown(wait=True)
+  shutil.rmtree(sim_folder)
+  return movements, memories
+
+
+def compare(serial, threads):
+  """
+  Returns a list of the differences between the (movements, memories) of
+  the two runs.
+  """
+  differences = []
+  for step, (a, b) in enumerate(zip(serial[0], threads[0])):
+    for persona_name in a["persona"]:
+      if a["persona"][persona_name] != b["persona"].get(persona_name):
+        differences += [f"step {step}, {persona_name}: "
+                        f"{a['persona'][persona_name]} != "
+                        f"{b['persona'].get(persona_name)}"]
+  for persona_name, nodes in serial[1].items():
+    if nodes != threads[1].get(persona_name):
+      differences += [f"associative memory of {persona_name} differs"]
+  return differences
+
+
+if __name__ == '__main__':
+  fork_sim_code = default_fork_sim_code
+  steps = default_steps
+  if len(sys.argv) > 1:
+    fork_sim_code = sys.argv[1]
+  if len(sys.argv) > 2:
+    steps = int(sys.argv[2])
+
+  # ReverieServer records the simulation it runs in <fs_temp_storage> for
+  # the frontend; the files of the user's own simulation are put back.
+  temp_files = dict()
+  for file_name in ["curr_sim_code.json", "curr_step.json"]:
+    if os.path.exists(f"{fs_temp_storage}/{file_name}"):
+      with open(f"{fs_temp_storage}/{file_name}") as infile:
+        temp_files[file_name] = infile.read()
+
+  install_stubs()
+  try:
+    serial = run_simulation(fork_sim_code, f"{fork_sim_code}-check-serial",
+                            "serial", steps)
+    threads = run_simulation(fork_sim_code, f"{fork_sim_code}-check-threads",
+                             "threads", steps)
+  finally:
+    for file_name in ["curr_sim_code.json", "curr_step.json"]:
+      if file_name in temp_files:
+        with open(f"{fs_temp_storage}/{file_name}", "w") as outfile:
+          outfile.write(temp_files[file_name])
+      elif os.path.exists(f"{fs_temp_storage}/{file_name}"):
+        os.remove(f"{fs_temp_storage}/{file_name}")
+
+  differences = compare(serial, threads)
+  for difference in differences:
+    print (difference)
+  print (f"{steps} steps of {fork_sim_code}: "
+         + ("serial and threads match" if not differences
+            else f"{len(differences)} differences"))
+  sys.exit(1 if differences else 0)
@@ -3,18 +3,31 @@ import os
 import datetime
 
 def load_persona_thoughts(base_path, persona_name):
-    nodes_path = os.path.join(base_path, "personas", persona_name, "bootstrap_memory", "associative_memory", "nodes.json")
-    thoughts = []
+    a_mem_path = os.path.join(base_path, "personas", persona_name, "bootstrap_memory", "associative_memory")
+    nodes_path = os.path.join(a_mem_path, "nodes.json")
+    journal_path = os.path.join(a_mem_path, "journal.jsonl")
+    nodes = dict()
     if os.path.exists(nodes_path):
         with open(nodes_path, "r", encoding="utf-8") as f:
             nodes = json.load(f)
-            for node_id, node_data in nodes.items():
-                if node_data["type"] == "thought":
-                    thoughts.append({
-                        "created": node_data["created"],
-                        "description": node_data["description"],
-                        "poignancy": node_data["poignancy"]
-                    })
+    # 尚未压缩进 nodes.json 的新节点记录在 journal.jsonl 中
+    if os.path.exists(journal_path):
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                nodes.setdefault(record["node_id"], record)
+
+    thoughts = []
+    for node_id, node_data in nodes.items():
+        if node_data["type"] == "thought":
+            thoughts.append({
+                "created": node_data["created"],
+                "description": node_data["description"],
+                "poignancy": node_data["poignancy"]
+            })
     return sorted(thoughts, key=lambda x: x["created"])
 
 def get_closest_thoughts(thoughts, current_time_dt, window_minutes=60):
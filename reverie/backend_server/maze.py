@@ -11,10 +11,20 @@ import datetime
 import pickle
 import time
 import math
+import hashlib
+import os
+import threading
 
 from global_methods import *
+from path_finder import *
 from utils import *
 
+# Distance fields to addresses (see Maze.get_distance_field) are kept in 
+# memory once built. If <distance_field_folder> is set, they are also saved 
+# there as .npy files, so that they survive a restart of the server. Set it to
+# None to keep them in memory only. 
+distance_field_folder = f"{fs_temp_storage}/distance_fields"
+
 class Maze: 
   def __init__(self, maze_name): 
     # READING IN THE BASIC META INFORMATION ABOUT THE MAP
@@ -108,6 +118,11 @@ class Maze:
       arena_maze += [arena_maze_raw[i:i+tw]]
       game_object_maze += [game_object_maze_raw[i:i+tw]]
       spawning_location_maze += [spawning_location_maze_raw[i:i+tw]]
+    # <passability_grid> is the collision maze in the flat form that the path
+    # finder works on. The collision maze never changes during a simulation, 
+    # so we build it once here and share it across all path searches. 
+    self.passability_grid = PassabilityGrid(self.collision_maze, 
+                                            collision_block_id)
 
     # Once we are done loading in the maze, we now set up self.tiles. This is
     # a matrix accessed by row:col where each access point is a dictionary
@@ -204,6 +219,18 @@ class Maze:
           else: 
             self.address_tiles[add] = set([(j, i)])
 
+    # <distance_fields> caches, per address string, the distance of every 
+    # tile to the closest tile of that address. They are built lazily, the 
+    # first time a persona heads to the address. 
+    # The on-disk copies are keyed by the collision layout, so that editing 
+    # the map never brings back stale fields. 
+    # Personas may be moved from several threads (see ReverieServer 
+    # step_mode), so a field is built under <distance_field_lock>. 
+    self.distance_fields = dict()
+    self.distance_field_lock = threading.Lock()
+    grid_hash = hashlib.sha1(bytes(self.passability_grid.passable))
+    self.distance_field_key = grid_hash.hexdigest()[:16]
+
 
   def turn_coordinate_to_tile(self, px_coordinate): 
     """
@@ -283,6 +310,105 @@ class Maze:
     return path
 
 
+  def shortest_path_to_any(self, start, targets): 
+    """
+    Finds the shortest path from <start> to the closest of <targets> in one
+    search. 
+
+    INPUT
+      start: The starting tile in (x, y) form. 
+      targets: A list of candidate target tiles in (x, y) form. 
+    OUTPUT
+      A (target, path) tuple. <target> is the closest reachable tile, and 
+      <path> is the list of (x, y) tuples from <start> to it. 
+    EXAMPLE OUTPUT
+      Given (58, 9) and [(60, 9), (58, 20)], 
+      ((60, 9), [(58, 9), (59, 9), (60, 9)])
+    """
+    return self.passability_grid.find_path_to_any(start, targets)
+
+
+  def get_distance_field(self, address): 
+    """
+    Returns the distance field of the given address, building it (or loading
+    it from <distance_field_folder>) on first use. 
+
+    INPUT
+      address: A string address that is in self.address_tiles. 
+    OUTPUT
+      A flat numpy int16 array with, for every tile, the number of steps to 
+      the closest tile of the address (-1 if it can not be reached). See 
+      PassabilityGrid.distance_field. 
+    """
+    if address in self.distance_fields: 
+      return self.distance_fields[address]
+
+    with self.distance_field_lock: 
+      # Another thread may have built the field while we waited. 
+      if address in self.distance_fields: 
+        return self.distance_fields[address]
+      field = self.load_or_build_distance_field(address)
+      self.distance_fields[address] = field
+    return field
+
+
+  def load_or_build_distance_field(self, address): 
+    """
+    Loads the distance field of <address> from <distance_field_folder>, or
+    builds it (and saves it there). Called by get_distance_field with 
+    <distance_field_lock> held. 
+    """
+    field_file = None
+    if distance_field_folder: 
+      address_hash = hashlib.sha1(address.encode("utf-8")).hexdigest()
+      field_file = (f"{distance_field_folder}/{self.maze_name}/"
+                    + f"{self.distance_field_key}/{address_hash}.npy")
+
+    field = None
+    if field_file and check_if_file_exists(field_file): 
+      try: 
+        field = numpy.load(field_file)
+      except Exception: 
+        field = None
+    if field is None: 
+      field = self.passability_grid.distance_field(self.address_tiles[address])
+      if field_file: 
+        create_folder_if_not_there(field_file)
+        # The lock only covers this Maze, and other Mazes or servers may 
+        # write the same file, so the temp name is unique per writer. 
+        tmp_file = (f"{field_file}.{os.getpid()}.{threading.get_ident()}"
+                    + ".tmp.npy")
+        numpy.save(tmp_file, field)
+        os.replace(tmp_file, field_file)
+    return field
+
+
+  def path_to_address(self, start, address): 
+    """
+    Finds the shortest path from <start> to the closest tile of <address> by
+    walking down the address' distance field. Once the field exists, this 
+    costs O(path length) no matter where the persona starts from. 
+
+    INPUT
+      start: The starting tile in (x, y) form. 
+      address: A string address that is in self.address_tiles. 
+    OUTPUT
+      A (target, path) tuple like shortest_path_to_any, or (None, None) if no
+      tile of the address can be reached from <start>. 
+    EXAMPLE OUTPUT
+      Given (58, 9) and "the ville:hobbs cafe:cafe:counter", 
+      ((60, 9), [(58, 9), (59, 9), (60, 9)])
+    """
+    start = tuple(start)
+    if start in self.address_tiles[address]: 
+      return start, [start]
+    path = self.passability_grid.path_from_field(
+      self.get_distance_field(address), start)
+    if not path: 
+      return None, None
+    return path[-1], path
+
+
   def get_nearby_tiles(self, tile, vision_r): 
     """
     Given the current tile and vision_r, return a list of tiles that are 
@@ -5,6 +5,8 @@ File: path_finder.py
 Description: Implements various path finding functions for generative agents.
 Some of the functions are defunct. 
 """
+import heapq
+from collections import deque
 import numpy as np
 
 def print_maze(maze):
@@ -161,7 +163,241 @@ def path_finder_v2(a, start, end, collision_block_char, verbose=False):
   return the_path
 
 
+class PassabilityGrid: 
+  """
+  A flat, read-only view of a collision maze that is built once (per Maze) 
+  and then shared by every path search. Tiles are addressed by their flat 
+  index y * width + x, and <passable> holds 1 for every tile a persona can 
+  walk on and 0 for collision blocks. 
+  """
+  def __init__(self, collision_maze, collision_block_char): 
+    self.height = len(collision_maze)
+    self.width = len(collision_maze[0])
+    self.passable = bytearray(self.width * self.height)
+    for y, row in enumerate(collision_maze): 
+      for x, tile in enumerate(row): 
+        if tile != collision_block_char: 
+          self.passable[y * self.width + x] = 1
+
+
+  def index(self, tile): 
+    return tile[1] * self.width + tile[0]
+
+
+  def tile(self, index): 
+    return (index % self.width, index // self.width)
+
+
+  def neighbors(self, index): 
+    """
+    Returns the flat indices of the passable tiles that are up, left, down
+    and right of <index> (in that order). 
+    """
+    ret = []
+    x = index % self.width
+    if index >= self.width and self.passable[index - self.width]: 
+      ret += [index - self.width]
+    if x > 0 and self.passable[index - 1]: 
+      ret += [index - 1]
+    if (index + self.width < len(self.passable) 
+        and self.passable[index + self.width]): 
+      ret += [index + self.width]
+    if x < self.width - 1 and self.passable[index + 1]: 
+      ret += [index + 1]
+    return ret
+
+
+  def find_path(self, start, end): 
+    """
+    A* search (4-connected, Manhattan heuristic) from <start> to <end>. Only 
+    the tiles that the search actually needs are visited, so a typical call
+    touches a few thousand tiles instead of rescanning the whole maze. 
+
+    INPUT
+      start: The starting tile in (x, y) form. It does not need to be 
+             passable itself. 
+      end: The target tile in (x, y) form. 
+    OUTPUT
+      A list of (x, y) tuples from <start> to <end> (both included). Like 
+      path_finder_v2, it returns [end] if <end> cannot be reached. 
+    EXAMPLE OUTPUT
+      Given (0, 1) and (3, 1) in an open corridor, 
+      [(0, 1), (1, 1), (2, 1), (3, 1)]
+    """
+    source = self.index(start)
+    target = self.index(end)
+    if source == target or not self.passable[target]: 
+      return [tuple(end)]
+
+    end_x, end_y = end
+    width = self.width
+    came_from = {source: None}
+    cost = {source: 0}
+    frontier = [(abs(start[0] - end_x) + abs(start[1] - end_y), 0, source)]
+    while frontier: 
+      _, curr_cost, curr = heapq.heappop(frontier)
+      if curr == target: 
+        break
+      if curr_cost > cost[curr]: 
+        continue
+      for nxt in self.neighbors(curr): 
+        nxt_cost = curr_cost + 1
+        if nxt not in cost or nxt_cost < cost[nxt]: 
+          cost[nxt] = nxt_cost
+          came_from[nxt] = curr
+          heuristic = abs(nxt % width - end_x) + abs(nxt // width - end_y)
+          heapq.heappush(frontier, (nxt_cost + heuristic, nxt_cost, nxt))
+    else: 
+      return [tuple(end)]
+
+    the_path = []
+    curr = target
+    while curr is not None: 
+      the_path.append(self.tile(curr))
+      curr = came_from[curr]
+    the_path.reverse()
+    return the_path
+
+
+  def find_path_to_any(self, start, targets): 
+    """
+    Breadth first search from <start> that stops at the first of <targets> 
+    it reaches. This replaces running one search per candidate target when
+    all we want is the closest one. 
+
+    INPUT
+      start: The starting tile in (x, y) form. 
+      targets: An iterable of candidate target tiles in (x, y) form. 
+    OUTPUT
+      A (target, path) tuple, where <target> is the closest reachable tile 
+      and <path> is the list of (x, y) tuples from <start> to it (both 
+      included). If no target can be reached, the first target is returned 
+      with the path [target] (see find_path). 
+    EXAMPLE OUTPUT
+      Given (0, 1) and [(3, 1), (1, 2)], ((1, 2), [(0, 1), (1, 1), (1, 2)])
+    """
+    targets = [tuple(i) for i in targets]
+    if not targets: 
+      return None, []
+    target_set = set()
+    for i in targets: 
+      target_set.add(self.index(i))
+
+    source = self.index(start)
+    came_from = {source: None}
+    frontier = deque([source])
+    found = None
+    if source in target_set: 
+      found = source
+    while frontier and found is None: 
+      curr = frontier.popleft()
+      for nxt in self.neighbors(curr): 
+        if nxt in came_from: 
+          continue
+        came_from[nxt] = curr
+        if nxt in target_set: 
+          found = nxt
+          break
+        frontier.append(nxt)
+
+    if found is None: 
+      return targets[0], [targets[0]]
+
+    the_path = []
+    curr = found
+    while curr is not None: 
+      the_path.append(self.tile(curr))
+      curr = came_from[curr]
+    the_path.reverse()
+    return the_path[-1], the_path
+
+
+  def distance_field(self, sources): 
+    """
+    Reverse breadth first search from all of <sources> at once. The result 
+    holds, for every tile, the number of steps to the closest source, so 
+    the path from any tile can later be read off by walking downhill (see 
+    path_from_field). 
+
+    INPUT
+      sources: An iterable of target tiles in (x, y) form. Like in 
+               find_path, collision tiles can not be reached. 
+    OUTPUT
+      A flat numpy int16 array of length width * height. Unreachable tiles
+      hold -1. 
+    """
+    dist = [-1] * len(self.passable)
+    frontier = deque()
+    for i in sources: 
+      index = self.index(i)
+      if self.passable[index] and dist[index] < 0: 
+        dist[index] = 0
+        frontier.append(index)
+    while frontier: 
+      curr = frontier.popleft()
+      nxt_dist = dist[curr] + 1
+      for nxt in self.neighbors(curr): 
+        if dist[nxt] < 0: 
+          dist[nxt] = nxt_dist
+          frontier.append(nxt)
+    return np.array(dist, dtype=np.int16)
+
+
+  def path_from_field(self, field, start): 
+    """
+    Walks down a distance field from <start> to its closest source. This 
+    costs O(path length). 
+
+    INPUT
+      field: A distance field from distance_field(). 
+      start: The starting tile in (x, y) form. It does not need to be 
+             passable itself. 
+    OUTPUT
+      A list of (x, y) tuples from <start> to the closest source (both 
+      included), or None if no source can be reached from <start>. 
+    """
+    curr = self.index(start)
+    the_path = [tuple(start)]
+    if field[curr] < 0: 
+      # <start> may be a collision tile that the reverse search never 
+      # entered. We step onto its closest passable neighbor first. 
+      best = None
+      for nxt in self.neighbors(curr): 
+        if field[nxt] >= 0 and (best is None or field[nxt] < field[best]): 
+          best = nxt
+      if best is None: 
+        return None
+      curr = best
+      the_path.append(self.tile(curr))
+
+    while field[curr] > 0: 
+      for nxt in self.neighbors(curr): 
+        if field[nxt] == field[curr] - 1: 
+          curr = nxt
+          break
+      the_path.append(self.tile(curr))
+    return the_path
+
+
 def path_finder(maze, start, end, collision_block_char, verbose=False):
+  """
+  Finds the shortest path between two tiles. 
+
+  INPUT
+    maze: A <PassabilityGrid>, or a raw collision maze (a list of rows) for
+          which a throwaway grid is built. 
+    start, end: Tiles in (x, y) form. 
+    collision_block_char: The collision block id used in the raw maze. 
+  OUTPUT
+    A list of (x, y) tuples from <start> to <end>, or [end] if there is no 
+    path. 
+  """
+  if isinstance(maze, PassabilityGrid): 
+    return maze.find_path(start, end)
+  return PassabilityGrid(maze, collision_block_char).find_path(start, end)
+
+
+def path_finder_legacy(maze, start, end, collision_block_char, verbose=False):
   # EMERGENCY PATCH
   start = (start[1], start[0])
   end = (end[1], end[0])
@@ -207,8 +443,10 @@ def path_finder_2(maze, start, end, collision_block_char, verbose=False):
   t_right = (end[0]+1, end[1])
   pot_target_coordinates = [t_top, t_bottom, t_left, t_right]
 
-  maze_width = len(maze[0]) 
-  maze_height = len(maze)
+  if not isinstance(maze, PassabilityGrid): 
+    maze = PassabilityGrid(maze, collision_block_char)
+  maze_width = maze.width
+  maze_height = maze.height
   target_coordinates = []
   for coordinate in pot_target_coordinates: 
     if coordinate[0] >= 0 and coordinate[0] < maze_width and coordinate[1] >= 0 and coordinate[1] < maze_height: 
@@ -241,18 +241,28 @@ def generate_poig_score(persona, event_type, description):
 
 
 def load_history_via_whisper(personas, whispers):
+  # The thoughts are generated first, with their embeddings submitted as 
+  # soon as each thought is known, so that they are encoded in batches while
+  # the remaining prompts run. The thoughts are then added in order. 
+  new_thoughts = []
   for count, row in enumerate(whispers): 
     persona = personas[row[0]]
     whisper = row[1]
 
     thought = generate_inner_thought(persona, whisper)
+    embedding_future = submit_embedding(thought)
 
     created = persona.scratch.curr_time
     expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
     s, p, o = generate_action_event_triple(thought, persona)
     keywords = set([s, p, o])
     thought_poignancy = generate_poig_score(persona, "event", whisper)
-    thought_embedding_pair = (thought, get_embedding(thought))
+    new_thoughts += [[persona, created, expiration, s, p, o, thought, 
+                      keywords, thought_poignancy, embedding_future]]
+
+  for (persona, created, expiration, s, p, o, thought, 
+       keywords, thought_poignancy, embedding_future) in new_thoughts: 
+    thought_embedding_pair = (thought, embedding_future.result())
     persona.a_mem.add_thought(created, expiration, s, p, o, 
                               thought, keywords, thought_poignancy, 
                               thought_embedding_pair, None)
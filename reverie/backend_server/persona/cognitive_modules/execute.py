@@ -41,6 +41,9 @@ def execute(persona, maze, personas, plan):
     # <target_tiles> is a list of tile coordinates where the persona may go 
     # to execute the current action. The goal is to pick one of them.
     target_tiles = None
+    # <target_address> is set when <target_tiles> are all the tiles of one 
+    # address, so that we can use the maze's distance field for it. 
+    target_address = None
 
     print ('aldhfoaf/????')
     print (plan)
@@ -49,25 +52,20 @@ def execute(persona, maze, personas, plan):
       # Executing persona-persona interaction.
       target_p_tile = (personas[plan.split("<persona>")[-1].strip()]
                        .scratch.curr_tile)
-      potential_path = path_finder(maze.collision_maze, 
+      potential_path = path_finder(maze.passability_grid, 
                                    persona.scratch.curr_tile, 
                                    target_p_tile, 
                                    collision_block_id)
       if len(potential_path) <= 2: 
         target_tiles = [potential_path[0]]
       else: 
-        potential_1 = path_finder(maze.collision_maze, 
-                                persona.scratch.curr_tile, 
-                                potential_path[int(len(potential_path)/2)], 
-                                collision_block_id)
-        potential_2 = path_finder(maze.collision_maze, 
-                                persona.scratch.curr_tile, 
-                                potential_path[int(len(potential_path)/2)+1], 
-                                collision_block_id)
-        if len(potential_1) <= len(potential_2): 
-          target_tiles = [potential_path[int(len(potential_path)/2)]]
-        else: 
-          target_tiles = [potential_path[int(len(potential_path)/2+1)]]
+        # We meet the other persona half way, at whichever of the two middle
+        # tiles of the path is closer. 
+        closer_tile, _ = maze.shortest_path_to_any(
+          persona.scratch.curr_tile, 
+          [potential_path[int(len(potential_path)/2)], 
+           potential_path[int(len(potential_path)/2)+1]])
+        target_tiles = [closer_tile]
     
     elif "<waiting>" in plan: 
       # Executing interaction where the persona has decided to wait before 
@@ -80,7 +78,7 @@ def execute(persona, maze, personas, plan):
       # Executing a random location action.
       plan = ":".join(plan.split(":")[:-1])
       target_tiles = maze.address_tiles[plan]
-      target_tiles = random.sample(list(target_tiles), 1)
+      target_tiles = persona.rng.sample(list(target_tiles), 1)
 
     else: 
       # This is our default execution. We simply take the persona to the
@@ -92,14 +90,12 @@ def execute(persona, maze, personas, plan):
         maze.address_tiles["Johnson Park:park:park garden"] #ERRORRRRRRR
       else: 
         target_tiles = maze.address_tiles[plan]
+        target_address = plan
 
     # There are sometimes more than one tile returned from this (e.g., a tabe
-    # may stretch many coordinates). So, we sample a few here. And from that 
-    # random sample, we will take the closest ones. 
-    if len(target_tiles) < 4: 
-      target_tiles = random.sample(list(target_tiles), len(target_tiles))
-    else:
-      target_tiles = random.sample(list(target_tiles), 4)
+    # may stretch many coordinates). We consider all of them, and take the 
+    # closest one below. 
+    target_tiles = [tuple(i) for i in target_tiles]
     # If possible, we want personas to occupy different tiles when they are 
     # headed to the same location on the maze. It is ok if they end up on the 
     # same time, but we try to lower that probability. 
@@ -119,26 +115,21 @@ def execute(persona, maze, personas, plan):
     target_tiles = new_target_tiles
 
     # Now that we've identified the target tile, we find the shortest path to
-    # one of the target tiles. 
-    curr_tile = persona.scratch.curr_tile
-    collision_maze = maze.collision_maze
-    closest_target_tile = None
-    path = None
-    for i in target_tiles: 
-      # path_finder takes a collision_mze and the curr_tile coordinate as 
-      # an input, and returns a list of coordinate tuples that becomes the
-      # path. 
-      # e.g., [(0, 1), (1, 1), (1, 2), (1, 3), (1, 4)...]
-      curr_path = path_finder(maze.collision_maze, 
-                              curr_tile, 
-                              i, 
-                              collision_block_id)
-      if not closest_target_tile: 
-        closest_target_tile = i
-        path = curr_path
-      elif len(curr_path) < len(path): 
-        closest_target_tile = i
-        path = curr_path
+    # one of the target tiles. A single search from curr_tile stops at the 
+    # closest target, and returns a list of coordinate tuples that becomes the
+    # path. 
+    # e.g., [(0, 1), (1, 1), (1, 2), (1, 3), (1, 4)...]
+    closest_target_tile, path = None, None
+    if (target_address 
+        and len(target_tiles) == len(maze.address_tiles[target_address])): 
+      # No tile of the address is taken by another persona, so the closest 
+      # tile of the whole address is what we want. The address' distance 
+      # field gives us that path without a new search. 
+      closest_target_tile, path = maze.path_to_address(
+        persona.scratch.curr_tile, target_address)
+    if not path: 
+      closest_target_tile, path = maze.shortest_path_to_any(
+        persona.scratch.curr_tile, target_tiles)
 
     # Actually setting the <planned_path> and <act_path_set>. We cut the 
     # first element in the planned_path because it includes the curr_tile. 
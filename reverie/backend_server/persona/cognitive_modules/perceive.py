@@ -22,52 +22,46 @@ def generate_poig_score(persona, event_type, description):
     return run_gpt_prompt_chat_poignancy(persona, 
                            persona.scratch.act_description)[0]
 
-def perceive(persona, maze): 
+def get_embedding_key(desc): 
   """
-  Perceives events around the persona and saves it to the memory, both events 
-  and spaces. 
+  Returns the part of an event description that is embedded: the text in
+  parentheses if there is one (e.g., "bed is (being used for sleeping)" -> 
+  "being used for sleeping"), and the whole description otherwise. 
+  """
+  if "(" in desc: 
+    return desc.split("(")[1].split(")")[0].strip()
+  return desc
 
-  We first perceive the events nearby the persona, as determined by its 
-  <vision_r>. If there are a lot of events happening within that radius, we 
-  take the <att_bandwidth> of the closest events. Finally, we check whether
-  any of them are new, as determined by <retention>. If they are new, then we
-  save those and return the <ConceptNode> instances for those events. 
+def perceive_space(persona, maze, nearby_tiles=None): 
+  """
+  Stores the tiles within the persona's vision radius in its spatial memory
+  (s_mem), which is in the form of a tree constructed using dictionaries. 
 
   INPUT: 
-    persona: An instance of <Persona> that represents the current persona. 
-    maze: An instance of <Maze> that represents the current maze in which the 
-          persona is acting in. 
+    nearby_tiles: the tiles within the persona's vision radius, if the 
+                  caller already has them. 
   OUTPUT: 
-    ret_events: a list of <ConceptNode> that are perceived and new. 
+    nearby_tiles: the tiles within the persona's vision radius. 
   """
-  # PERCEIVE SPACE
-  # We get the nearby tiles given our current tile and the persona's vision
-  # radius. 
-  nearby_tiles = maze.get_nearby_tiles(persona.scratch.curr_tile, 
-                                       persona.scratch.vision_r)
-
-  # We then store the perceived space. Note that the s_mem of the persona is
-  # in the form of a tree constructed using dictionaries. 
+  if nearby_tiles is None: 
+    nearby_tiles = maze.get_nearby_tiles(persona.scratch.curr_tile, 
+                                         persona.scratch.vision_r)
   for i in nearby_tiles: 
     i = maze.access_tile(i)
-    if i["world"]: 
-      if (i["world"] not in persona.s_mem.tree): 
-        persona.s_mem.tree[i["world"]] = {}
-    if i["sector"]: 
-      if (i["sector"] not in persona.s_mem.tree[i["world"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]] = {}
-    if i["arena"]: 
-      if (i["arena"] not in persona.s_mem.tree[i["world"]]
-                                              [i["sector"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] = []
-    if i["game_object"]: 
-      if (i["game_object"] not in persona.s_mem.tree[i["world"]]
-                                                    [i["sector"]]
-                                                    [i["arena"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] += [
-                                                             i["game_object"]]
+    persona.s_mem.add_location(i["world"], i["sector"], i["arena"], 
+                               i["game_object"])
+  return nearby_tiles
 
-  # PERCEIVE EVENTS. 
+def get_perceived_events(persona, maze, nearby_tiles): 
+  """
+  Lists the events the persona perceives: the <att_bandwidth> closest 
+  events in <nearby_tiles> that take place in the persona's current arena. 
+
+  OUTPUT: 
+    a list of (subject, predicate, object, description) tuples, closest 
+    first. e.g., [("Isabella Rodriguez", "is", "sleeping", 
+                   "Isabella Rodriguez is sleeping"), ...]
+  """
   # We will perceive events that take place in the same arena as the
   # persona's current arena. 
   curr_arena_path = maze.get_tile_path(persona.scratch.curr_tile, "arena")
@@ -102,10 +96,7 @@ def perceive(persona, maze):
   for dist, event in percept_events_list[:persona.scratch.att_bandwidth]: 
     perceived_events += [event]
 
-  # Storing events. 
-  # <ret_events> is a list of <ConceptNode> instances from the persona's 
-  # associative memory. 
-  ret_events = []
+  new_events = []
   for p_event in perceived_events: 
     s, p, o, desc = p_event
     if not p: 
@@ -114,6 +105,65 @@ def perceive(persona, maze):
       o = "idle"
       desc = "idle"
     desc = f"{s.split(':')[-1]} is {desc}"
+    new_events += [(s, p, o, desc)]
+  return new_events
+
+def has_new_events(persona, maze, nearby_tiles): 
+  """
+  Checks, without changing the persona's memory, whether perceive would 
+  store any event (that is, whether any perceived event is not among the 
+  latest <retention> events of the persona). 
+  """
+  latest_events = persona.a_mem.get_summarized_latest_events(
+                                  persona.scratch.retention)
+  for s, p, o, desc in get_perceived_events(persona, maze, nearby_tiles): 
+    if (s, p, o) not in latest_events: 
+      return True
+  return False
+
+def perceive(persona, maze, nearby_tiles=None): 
+  """
+  Perceives events around the persona and saves it to the memory, both events 
+  and spaces. 
+
+  We first perceive the events nearby the persona, as determined by its 
+  <vision_r>. If there are a lot of events happening within that radius, we 
+  take the <att_bandwidth> of the closest events. Finally, we check whether
+  any of them are new, as determined by <retention>. If they are new, then we
+  save those and return the <ConceptNode> instances for those events. 
+
+  INPUT: 
+    persona: An instance of <Persona> that represents the current persona. 
+    maze: An instance of <Maze> that represents the current maze in which the 
+          persona is acting in. 
+    nearby_tiles: the tiles within the persona's vision radius, if the 
+                  caller already has them. 
+  OUTPUT: 
+    ret_events: a list of <ConceptNode> that are perceived and new. 
+  """
+  # PERCEIVE SPACE
+  # We get the nearby tiles given our current tile and the persona's vision
+  # radius, and store the perceived space. 
+  nearby_tiles = perceive_space(persona, maze, nearby_tiles)
+
+  # PERCEIVE EVENTS. 
+  new_events = get_perceived_events(persona, maze, nearby_tiles)
+
+  # Storing events. 
+  # <ret_events> is a list of <ConceptNode> instances from the persona's 
+  # associative memory. 
+  ret_events = []
+
+  # The embeddings that the persona does not have yet are all requested 
+  # before the first poignancy prompt, so that they are encoded together. 
+  embedding_futures = dict()
+  for s, p, o, desc in new_events: 
+    desc_embedding_in = get_embedding_key(desc)
+    if (desc_embedding_in not in persona.a_mem.embeddings 
+        and desc_embedding_in not in embedding_futures): 
+      embedding_futures[desc_embedding_in] = submit_embedding(desc_embedding_in)
+
+  for s, p, o, desc in new_events: 
     p_event = (s, p, o)
 
     # We retrieve the latest persona.scratch.retention events. If there is  
@@ -133,15 +183,11 @@ def perceive(persona, maze):
       keywords.update([sub, obj])
 
       # Get event embedding
-      desc_embedding_in = desc
-      if "(" in desc: 
-        desc_embedding_in = (desc_embedding_in.split("(")[1]
-                                              .split(")")[0]
-                                              .strip())
+      desc_embedding_in = get_embedding_key(desc)
       if desc_embedding_in in persona.a_mem.embeddings: 
         event_embedding = persona.a_mem.embeddings[desc_embedding_in]
       else: 
-        event_embedding = get_embedding(desc_embedding_in)
+        event_embedding = embedding_futures[desc_embedding_in].result()
       event_embedding_pair = (desc_embedding_in, event_embedding)
       
       # Get event poignancy. 
@@ -8,7 +8,9 @@ import datetime
 import math
 import random 
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append('../../')
 
 from global_methods import *
@@ -16,6 +18,56 @@ from persona.prompt_template.run_gpt_prompt import *
 from persona.cognitive_modules.retrieve import *
 from persona.cognitive_modules.converse import *
 
+# <hourly_schedule_mode> picks how generate_hourly_schedule fills in the day:
+# "per_hour" asks for one hour at a time (one LLM call per waking hour), and
+# "single_call" asks for all waking hours in one structured call, falling 
+# back to the per hour prompt only for the hours the response left out. 
+hourly_schedule_mode = "per_hour"
+
+# _determine_action runs the prompts of a new action that do not depend on 
+# each other's output in this pool, so that they wait on the API server at 
+# the same time. Only the calling thread's location chain (sector -> arena 
+# -> game object -> object description) has to run in order. The pool is 
+# sized like the LLM client (<llm_max_concurrency>), since more workers 
+# would only wait on its semaphore. 
+action_pipeline_executor = None
+_action_pipeline_lock = threading.Lock()
+
+def get_action_pipeline_executor(): 
+  """
+  Returns the action pipeline pool, creating it on first use. 
+  """
+  global action_pipeline_executor
+  with _action_pipeline_lock: 
+    if action_pipeline_executor is None: 
+      action_pipeline_executor = ThreadPoolExecutor(
+        max_workers=llm_max_concurrency, thread_name_prefix="action-pipeline")
+  return action_pipeline_executor
+
+# With <location_memo_enabled>, the sector, arena and game object chosen for
+# an action are remembered per persona (see resolve_action_location). 
+location_memo_enabled = True
+
+# With <plan_template_cache_enabled>, generate_task_decomp reuses the 
+# decompositions the persona made before (see Scratch.plan_templates) for a 
+# task with the same duration, on any day. Up to 
+# <plan_template_cache_max_entries> are kept per persona, and the least 
+# recently used one is dropped first. 
+plan_template_cache_enabled = True
+plan_template_cache_max_entries = 500
+
+# <daily_planning_mode> picks how _long_term_planning plans a new day: 
+# "regenerate" makes a new wake up hour and hourly schedule, and "routine" 
+# starts from yesterday's hourly schedule and only asks for the hours that 
+# change today, in one LLM call (see generate_routine_hourly_schedule). 
+daily_planning_mode = "regenerate"
+
+day_hour_str = ["00:00 AM", "01:00 AM", "02:00 AM", "03:00 AM", "04:00 AM", 
+                "05:00 AM", "06:00 AM", "07:00 AM", "08:00 AM", "09:00 AM", 
+                "10:00 AM", "11:00 AM", "12:00 PM", "01:00 PM", "02:00 PM", 
+                "03:00 PM", "04:00 PM", "05:00 PM", "06:00 PM", "07:00 PM",
+                "08:00 PM", "09:00 PM", "10:00 PM", "11:00 PM"]
+
 ##############################################################################
 # CHAPTER 2: Generate
 ##############################################################################
@@ -89,16 +141,16 @@ def generate_hourly_schedule(persona, wake_up_hour):
   """
   if debug: print ("GNS FUNCTION: <generate_hourly_schedule>")
 
-  hour_str = ["00:00 AM", "01:00 AM", "02:00 AM", "03:00 AM", "04:00 AM", 
-              "05:00 AM", "06:00 AM", "07:00 AM", "08:00 AM", "09:00 AM", 
-              "10:00 AM", "11:00 AM", "12:00 PM", "01:00 PM", "02:00 PM", 
-              "03:00 PM", "04:00 PM", "05:00 PM", "06:00 PM", "07:00 PM",
-              "08:00 PM", "09:00 PM", "10:00 PM", "11:00 PM"]
+  hour_str = day_hour_str
   n_m1_activity = []
   diversity_repeat_count = 3
   for i in range(diversity_repeat_count): 
     n_m1_activity_set = set(n_m1_activity)
     if len(n_m1_activity_set) < 5: 
+      if hourly_schedule_mode == "single_call": 
+        n_m1_activity = generate_full_day_activities(persona, wake_up_hour, 
+                                                     hour_str)
+        continue
       n_m1_activity = []
       for count, curr_hour_str in enumerate(hour_str): 
         if wake_up_hour > 0: 
@@ -107,7 +159,23 @@ def generate_hourly_schedule(persona, wake_up_hour):
         else: 
           n_m1_activity += [run_gpt_prompt_generate_hourly_schedule(
                           persona, curr_hour_str, n_m1_activity, hour_str)[0]]
-  
+
+  return compress_hourly_activities(n_m1_activity)
+
+
+def compress_hourly_activities(n_m1_activity): 
+  """
+  Turns the activity of each hour of the day into a list of activities and 
+  their duration in minutes. 
+
+  INPUT: 
+    n_m1_activity: a list with the activity of each of the 24 hours. 
+  OUTPUT: 
+    a list of activities and their duration in minutes: 
+  EXAMPLE OUTPUT: 
+    [['sleeping', 360], ['waking up and starting her morning routine', 60], 
+     ['eating breakfast', 60],..
+  """
   # Step 1. Compressing the hourly schedule to the following format: 
   # The integer indicates the number of hours. They should add up to 24. 
   # [['sleeping', 6], ['waking up and starting her morning routine', 1], 
@@ -138,6 +206,84 @@ def generate_hourly_schedule(persona, wake_up_hour):
   return n_m1_hourly_compressed
 
 
+def generate_full_day_activities(persona, wake_up_hour, hour_str): 
+  """
+  The "single_call" mode of generate_hourly_schedule: gets the activity of 
+  every waking hour from one LLM call, and only asks for the hours missing 
+  from its response one at a time. 
+
+  INPUT: 
+    persona: The Persona class instance 
+    wake_up_hour: Integer form of the wake up hour for the persona. 
+    hour_str: The list of the 24 hour strings. 
+  OUTPUT: 
+    a list with the activity of each hour (before compression). 
+  EXAMPLE OUTPUT: 
+    ['sleeping', 'sleeping', ..., 'eating breakfast', ...]
+  """
+  activities = run_gpt_prompt_generate_full_day_schedule(persona, 
+                                                         wake_up_hour, 
+                                                         hour_str)[0]
+  n_m1_activity = []
+  for count, curr_hour_str in enumerate(hour_str): 
+    if count < wake_up_hour: 
+      n_m1_activity += ["sleeping"]
+    elif activities[count]: 
+      n_m1_activity += [activities[count]]
+    else: 
+      n_m1_activity += [run_gpt_prompt_generate_hourly_schedule(
+                      persona, curr_hour_str, n_m1_activity, hour_str)[0]]
+  return n_m1_activity
+
+
+def expand_hourly_schedule(hourly_schedule): 
+  """
+  The reverse of compress_hourly_activities: gives the activity of each of 
+  the 24 hours (the one going on at the start of the hour). 
+
+  INPUT: 
+    hourly_schedule: a list of activities and their duration in minutes 
+                     (e.g., [['sleeping', 360], ['eating breakfast', 60], ..])
+  OUTPUT: 
+    a list with the activity of each hour. 
+  EXAMPLE OUTPUT: 
+    ['sleeping', 'sleeping', ..., 'eating breakfast', ...]
+  """
+  activities = []
+  end_min = 0
+  for task, duration in hourly_schedule: 
+    end_min += duration
+    while len(activities) < 24 and len(activities) * 60 < end_min: 
+      activities += [task]
+  while activities and len(activities) < 24: 
+    activities += [activities[-1]]
+  return activities
+
+
+def generate_routine_hourly_schedule(persona): 
+  """
+  The "routine" mode of _long_term_planning: today's hourly schedule is 
+  yesterday's, with the hours that one LLM call says should change today 
+  (given the revised <currently> and <daily_plan_req>) replaced. 
+
+  INPUT: 
+    persona: The Persona class instance 
+  OUTPUT: 
+    a list of activities and their duration in minutes, as in 
+    generate_hourly_schedule. 
+  """
+  if debug: print ("GNS FUNCTION: <generate_routine_hourly_schedule>")
+  prev_activities = expand_hourly_schedule(
+                      persona.scratch.f_daily_schedule_hourly_org)
+  revisions = run_gpt_prompt_revise_hourly_schedule(persona, 
+                                                    prev_activities, 
+                                                    day_hour_str)[0]
+  n_m1_activity = []
+  for prev_activity, revision in zip(prev_activities, revisions): 
+    n_m1_activity += [revision or prev_activity]
+  return compress_hourly_activities(n_m1_activity)
+
+
 def generate_task_decomp(persona, task, duration): 
   """
   A few shot decomposition of a task given the task description 
@@ -161,7 +307,22 @@ def generate_task_decomp(persona, task, duration):
 
   """
   if debug: print ("GNS FUNCTION: <generate_task_decomp>")
-  return run_gpt_prompt_task_decomp(persona, task, duration)[0]
+  if not plan_template_cache_enabled: 
+    return run_gpt_prompt_task_decomp(persona, task, duration)[0]
+
+  plan_templates = persona.scratch.plan_templates
+  template_key = f"{persona.scratch.get_identity_hash()}|{duration}|{task}"
+  if template_key in plan_templates: 
+    # Moved to the end, so that the least recently used one is first. 
+    plan_templates[template_key] = plan_templates.pop(template_key)
+  else: 
+    while len(plan_templates) >= plan_template_cache_max_entries: 
+      del plan_templates[next(iter(plan_templates))]
+    plan_templates[template_key] = run_gpt_prompt_task_decomp(persona, task, 
+                                                              duration)[0]
+  # The schedule gets a copy, so that changes to it do not reach the cache. 
+  return [[decomp_task, decomp_dura] 
+          for decomp_task, decomp_dura in plan_templates[template_key]]
 
 
 def generate_action_sector(act_desp, persona, maze): 
@@ -223,6 +384,45 @@ def generate_action_game_object(act_desp, act_address, persona, maze):
   return run_gpt_prompt_action_game_object(act_desp, persona, maze, act_address)[0]
 
 
+def resolve_action_location(act_desp, persona, maze, act_world): 
+  """
+  Chooses the sector, arena and game object for an action. The choice is 
+  remembered in the persona's location memo under the action description 
+  and the sector the persona is in, for as long as its spatial memory does 
+  not change (any new place resets the memo), so recurring actions are 
+  placed without asking the LLM again. 
+
+  INPUT: 
+    act_desp: description of the new action (e.g., "sleeping")
+    persona: The Persona class instance 
+    maze: Current <Maze> instance. 
+    act_world: The world the persona is in. 
+  OUTPUT: 
+    a tuple of the sector, the arena and the game object. 
+  EXAMPLE OUTPUT: 
+    ("Lin family's house", "Eddy Lin's bedroom", "bed")
+  """
+  memo = persona.scratch.location_memo
+  if memo.get("version") != persona.s_mem.version: 
+    memo.clear()
+    memo["version"] = persona.s_mem.version
+    memo["entries"] = dict()
+
+  curr_sector = maze.access_tile(persona.scratch.curr_tile)["sector"]
+  memo_key = f"{act_world}:{curr_sector}|{act_desp}"
+  if location_memo_enabled and memo_key in memo["entries"]: 
+    return tuple(memo["entries"][memo_key])
+
+  act_sector = generate_action_sector(act_desp, persona, maze)
+  act_arena = generate_action_arena(act_desp, persona, maze, act_world, 
+                                    act_sector)
+  act_address = f"{act_world}:{act_sector}:{act_arena}"
+  act_game_object = generate_action_game_object(act_desp, act_address,
+                                                persona, maze)
+  memo["entries"][memo_key] = [act_sector, act_arena, act_game_object]
+  return act_sector, act_arena, act_game_object
+
+
 def generate_action_pronunciatio(act_desp, persona): 
   """TODO 
   Given an action description, creates an emoji string description via a few
@@ -468,8 +668,15 @@ def _long_term_planning(persona, new_day):
              "New day", or False (for neither). This is important because we
              create the personas' long term planning on the new day. 
   """
+  # In "routine" mode, a new day starts from yesterday's hourly schedule, so
+  # it needs neither a wake up hour nor a new schedule. 
+  routine_day = (new_day == "New day" 
+                 and daily_planning_mode == "routine" 
+                 and persona.scratch.f_daily_schedule_hourly_org)
+
   # We start by creating the wake up hour for the persona. 
-  wake_up_hour = generate_wake_up_hour(persona)
+  if not routine_day: 
+    wake_up_hour = generate_wake_up_hour(persona)
 
   # When it is a new day, we start by creating the daily_req of the persona.
   # Note that the daily_req is a list of strings that describe the persona's
@@ -491,8 +698,12 @@ def _long_term_planning(persona, new_day):
   # Based on the daily_req, we create an hourly schedule for the persona, 
   # which is a list of todo items with a time duration (in minutes) that 
   # add up to 24 hours.
-  persona.scratch.f_daily_schedule = generate_hourly_schedule(persona, 
-                                                              wake_up_hour)
+  if routine_day: 
+    persona.scratch.f_daily_schedule = generate_routine_hourly_schedule(
+                                         persona)
+  else: 
+    persona.scratch.f_daily_schedule = generate_hourly_schedule(persona, 
+                                                                wake_up_hour)
   persona.scratch.f_daily_schedule_hourly_org = (persona.scratch
                                                    .f_daily_schedule[:])
 
@@ -603,9 +814,7 @@ def _determine_action(persona, maze):
   print ("------")
 
   # 1440
-  x_emergency = 0
-  for i in persona.scratch.f_daily_schedule: 
-    x_emergency += i[1]
+  x_emergency = persona.scratch.f_daily_schedule.get_total_min()
   # print ("x_emergency", x_emergency)
 
   if 1440 - x_emergency > 0: 
@@ -619,23 +828,30 @@ def _determine_action(persona, maze):
 
 
 
+  # The emoji and the event triple of the action only depend on its 
+  # description, so they are generated while we find its location. 
+  executor = get_action_pipeline_executor()
+  act_pron_future = executor.submit(
+    generate_action_pronunciatio, act_desp, persona)
+  act_event_future = executor.submit(
+    generate_action_event_triple, act_desp, persona)
+
   # Finding the target location of the action and creating action-related
   # variables.
   act_world = maze.access_tile(persona.scratch.curr_tile)["world"]
   # act_sector = maze.access_tile(persona.scratch.curr_tile)["sector"]
-  act_sector = generate_action_sector(act_desp, persona, maze)
-  act_arena = generate_action_arena(act_desp, persona, maze, act_world, act_sector)
-  act_address = f"{act_world}:{act_sector}:{act_arena}"
-  act_game_object = generate_action_game_object(act_desp, act_address,
-                                                persona, maze)
+  act_sector, act_arena, act_game_object = resolve_action_location(
+    act_desp, persona, maze, act_world)
   new_address = f"{act_world}:{act_sector}:{act_arena}:{act_game_object}"
-  act_pron = generate_action_pronunciatio(act_desp, persona)
-  act_event = generate_action_event_triple(act_desp, persona)
   # Persona's actions also influence the object states. We set those up here. 
   act_obj_desp = generate_act_obj_desc(act_game_object, act_desp, persona)
-  act_obj_pron = generate_action_pronunciatio(act_obj_desp, persona)
+  act_obj_pron_future = executor.submit(
+    generate_action_pronunciatio, act_obj_desp, persona)
   act_obj_event = generate_act_obj_event_triple(act_game_object, 
                                                 act_obj_desp, persona)
+  act_pron = act_pron_future.result()
+  act_event = act_event_future.result()
+  act_obj_pron = act_obj_pron_future.result()
 
   # Adding the action to persona's queue. 
   persona.scratch.add_new_action(new_address, 
@@ -684,7 +900,7 @@ def _choose_retrieved(persona, retrieved):
         and curr_event.subject != persona.name): 
       priority += [rel_ctx]
   if priority: 
-    return random.choice(priority)
+    return persona.rng.choice(priority)
 
   # Skip idle. 
   for event_desc, rel_ctx in retrieved.items(): 
@@ -692,7 +908,7 @@ def _choose_retrieved(persona, retrieved):
     if "is idle" not in event_desc: 
       priority += [rel_ctx]
   if priority: 
-    return random.choice(priority)
+    return persona.rng.choice(priority)
   return None
 
 
@@ -810,34 +1026,26 @@ def _create_react(persona, inserted_act, inserted_act_dur,
                   act_obj_event, act_start_time=None): 
   p = persona 
 
-  min_sum = 0
-  for i in range (p.scratch.get_f_daily_schedule_hourly_org_index()): 
-    min_sum += p.scratch.f_daily_schedule_hourly_org[i][1]
+  hourly_org = p.scratch.f_daily_schedule_hourly_org
+  hourly_org_index = p.scratch.get_f_daily_schedule_hourly_org_index()
+  min_sum = hourly_org.get_start_min(hourly_org_index)
   start_hour = int (min_sum/60)
 
-  if (p.scratch.f_daily_schedule_hourly_org[p.scratch.get_f_daily_schedule_hourly_org_index()][1] >= 120):
-    end_hour = start_hour + p.scratch.f_daily_schedule_hourly_org[p.scratch.get_f_daily_schedule_hourly_org_index()][1]/60
+  if (hourly_org[hourly_org_index][1] >= 120):
+    end_hour = start_hour + hourly_org[hourly_org_index][1]/60
 
-  elif (p.scratch.f_daily_schedule_hourly_org[p.scratch.get_f_daily_schedule_hourly_org_index()][1] + 
-      p.scratch.f_daily_schedule_hourly_org[p.scratch.get_f_daily_schedule_hourly_org_index()+1][1]): 
-    end_hour = start_hour + ((p.scratch.f_daily_schedule_hourly_org[p.scratch.get_f_daily_schedule_hourly_org_index()][1] + 
-              p.scratch.f_daily_schedule_hourly_org[p.scratch.get_f_daily_schedule_hourly_org_index()+1][1])/60)
+  elif (hourly_org[hourly_org_index][1] + 
+      hourly_org[hourly_org_index+1][1]): 
+    end_hour = start_hour + ((hourly_org[hourly_org_index][1] + 
+              hourly_org[hourly_org_index+1][1])/60)
 
   else: 
     end_hour = start_hour + 2
   end_hour = int(end_hour)
 
-  dur_sum = 0
-  count = 0 
-  start_index = None
-  end_index = None
-  for act, dur in p.scratch.f_daily_schedule: 
-    if dur_sum >= start_hour * 60 and start_index == None:
-      start_index = count
-    if dur_sum >= end_hour * 60 and end_index == None: 
-      end_index = count
-    dur_sum += dur
-    count += 1
+  start_index = p.scratch.f_daily_schedule.get_index_starting_at(
+                  start_hour * 60)
+  end_index = p.scratch.f_daily_schedule.get_index_starting_at(end_hour * 60)
 
   ret = generate_new_decomp_schedule(p, inserted_act, inserted_act_dur, 
                                        start_hour, end_hour)
@@ -995,17 +1203,25 @@ def plan(persona, maze, personas, new_day, retrieved):
     persona.scratch.chatting_with = None
     persona.scratch.chat = None
     persona.scratch.chatting_end_time = None
-  # We want to make sure that the persona does not keep conversing with each
-  # other in an infinite loop. So, chatting_with_buffer maintains a form of 
-  # buffer that makes the persona wait from talking to the same target 
-  # immediately after chatting once. We keep track of the buffer value here. 
+  advance_chatting_with_buffer(persona)
+
+  return persona.scratch.act_address
+
+
+def advance_chatting_with_buffer(persona): 
+  """
+  Counts down the chatting_with_buffer by one step. 
+
+  We want to make sure that the persona does not keep conversing with each
+  other in an infinite loop. So, chatting_with_buffer maintains a form of 
+  buffer that makes the persona wait from talking to the same target 
+  immediately after chatting once. We keep track of the buffer value here. 
+  """
   curr_persona_chat_buffer = persona.scratch.chatting_with_buffer
   for persona_name, buffer_count in curr_persona_chat_buffer.items():
     if persona_name != persona.scratch.chatting_with: 
       persona.scratch.chatting_with_buffer[persona_name] -= 1
 
-  return persona.scratch.act_address
-
 
 
 
@@ -19,15 +19,15 @@ from persona.cognitive_modules.retrieve import *
 def generate_focal_points(persona, n=5): # 改装点：由3增加到5，扩大思考广度
   if debug: print ("GNS FUNCTION: <generate_focal_points>")
   
-  nodes = [[i.last_accessed, i]
-            for i in persona.a_mem.seq_event + persona.a_mem.seq_thought
-            if "idle" not in i.embedding_key]
-
-  nodes = sorted(nodes, key=lambda x: x[0])
-  nodes = [i for created, i in nodes]
+  # The latest <importance_ele_n> accessed nodes (all of them when it is 0, 
+  # as in nodes[-0:]). 
+  if persona.scratch.importance_ele_n: 
+    nodes = persona.a_mem.get_latest_accessed(persona.scratch.importance_ele_n)
+  else: 
+    nodes = persona.a_mem.get_recency_order()
 
   statements = ""
-  for node in nodes[-1*persona.scratch.importance_ele_n:]: 
+  for node in nodes: 
     statements += node.embedding_key + "\n"
 
   # 这里的 n 已经变为 5
@@ -107,7 +107,10 @@ def run_reflect(persona):
   for focal_pt, nodes in retrieved.items(): 
     # 每个关注点生成 8 个见解
     thoughts = generate_insights_and_evidence(persona, nodes, 8)
-    for thought, evidence in thoughts.items(): 
+    # All thoughts are submitted for embedding at once, and encoded in one 
+    # batch while the triple and poignancy prompts run. 
+    embedding_futures = [submit_embedding(thought) for thought in thoughts]
+    for count, (thought, evidence) in enumerate(thoughts.items()): 
       created = persona.scratch.curr_time
       expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
       s, p, o = generate_action_event_triple(thought, persona)
@@ -115,7 +118,7 @@ def run_reflect(persona):
       
       # 这里会调用我们改装后的戏剧化评分
       thought_poignancy = generate_poig_score(persona, "thought", thought)
-      thought_embedding_pair = (thought, get_embedding(thought))
+      thought_embedding_pair = (thought, embedding_futures[count].result())
 
       persona.a_mem.add_thought(created, expiration, s, p, o, 
                                 thought, keywords, thought_poignancy, 
@@ -10,9 +10,19 @@ sys.path.append('../../')
 from global_methods import *
 from persona.prompt_template.gpt_structure import *
 
+import numpy
 from numpy import dot
 from numpy.linalg import norm
 
+# With <ann_retrieve>, new_retrieve only scores the relevance of a candidate 
+# pool per focal point: the <ann_candidates> nodes the persona's ANN index 
+# (see ann_index.py) finds most similar to it, plus the nodes with the 
+# highest recency scores and the most important nodes, so that the pool 
+# holds the top nodes of the other two components. Below <ann_candidates> 
+# nodes, retrieval is always exact. 
+ann_retrieve = False
+ann_candidates = 200
+
 def retrieve(persona, perceived): 
   """
   This function takes the events that are perceived by the persona as input
@@ -196,12 +206,147 @@ def extract_relevance(persona, nodes, focal_pt):
   return relevance_out
 
 
+def normalize_array(a, target_min, target_max): 
+  """
+  The array counterpart of normalize_dict_floats. Scales the values of 'a'
+  to the target range while keeping their relative proportions. If all 
+  values are equal, they all become (target_max - target_min)/2. 
+
+  INPUT: 
+    a: 1-D numpy array of floats. 
+    target_min: Integer or float. The minimum of the target range. 
+    target_max: Integer or float. The maximum of the target range. 
+  OUTPUT: 
+    A new 1-D numpy array with the normalized values. 
+  """
+  min_val = a.min()
+  range_val = a.max() - min_val
+  if range_val == 0: 
+    return numpy.full(len(a), (target_max - target_min)/2)
+  return (a - min_val) * (target_max - target_min) / range_val + target_min
+
+
+def top_x_indices(scores, x): 
+  """
+  The array counterpart of top_highest_x_values. Returns the indices of the
+  x highest scores, highest first. Only the top x are sorted (argpartition 
+  finds them first), and ties are broken by the smaller index, which is the
+  order the stable sort in top_highest_x_values would give. 
+
+  INPUT: 
+    scores: 1-D numpy array of floats. 
+    x: Integer. The number of indices to return. 
+  OUTPUT: 
+    A 1-D numpy array of at most x indices into 'scores'. 
+  """
+  if x <= 0: 
+    return numpy.zeros(0, dtype=int)
+  if x >= len(scores): 
+    candidates = numpy.arange(len(scores))
+  else: 
+    candidates = numpy.argpartition(-scores, x - 1)[:x]
+  order = numpy.lexsort((candidates, -scores[candidates]))
+  return candidates[order]
+
+
+def extract_recency_array(persona, nodes): 
+  """
+  Array version of extract_recency. <nodes> is sorted by last_accessed, 
+  oldest first; the i-th node gets recency_decay ** (i+1). 
+  """
+  return persona.scratch.recency_decay ** numpy.arange(1, len(nodes) + 1)
+
+
+def extract_importance_array(persona, nodes): 
+  """
+  Array version of extract_importance. 
+  """
+  return numpy.fromiter((node.poignancy for node in nodes), 
+                        dtype=float, count=len(nodes))
+
+
+def extract_relevance_matrix(persona, nodes, focal_points): 
+  """
+  Batched, array version of extract_relevance. All focal points are embedded
+  in one call, and the cosine similarity of every node to every focal point
+  comes from one product with the persona's embedding matrix. 
+
+  OUTPUT: 
+    A numpy array of shape (len(focal_points), len(nodes)). 
+  """
+  embeddings = persona.a_mem.embeddings
+  rows = numpy.fromiter((embeddings.row(node.embedding_key) for node in nodes), 
+                        dtype=int, count=len(nodes))
+  return embeddings.cosine_similarities(get_embeddings(focal_points))[:, rows]
+
+
+def extract_relevance_candidates(persona, nodes, node_positions, 
+                                 focal_embedding, extra_positions): 
+  """
+  Approximate version of a row of extract_relevance_matrix. Relevance is 
+  only computed for a candidate pool: the nodes the ANN index returns for 
+  <focal_embedding>, and the nodes at <extra_positions>. 
+
+  INPUT: 
+    persona: Current persona whose memory we are retrieving. 
+    nodes: The list of nodes new_retrieve scores. 
+    node_positions: A dictionary of node_id -> position in <nodes>. 
+    focal_embedding: The embedding of the focal point. 
+    extra_positions: Positions in <nodes> that are always in the pool. 
+  OUTPUT: 
+    A numpy array with the relevance of every node in <nodes>, which is nan
+    for the nodes that are not in the pool. 
+  """
+  index = persona.a_mem.get_ann_index()
+  pool = set(int(i) for i in extra_positions)
+  for row in index.search(focal_embedding, ann_candidates): 
+    pool.add(node_positions[index.nodes[row].node_id])
+  pool = numpy.array(sorted(pool))
+
+  relevance = numpy.full(len(nodes), numpy.nan)
+  rows = [index.node_to_row[nodes[i].node_id] for i in pool]
+  relevance[pool] = index.similarities(focal_embedding, rows)
+  return relevance
+
+
+def update_recency_order(order, moved, accessed, tie_keys): 
+  """
+  Updates <order> (node positions sorted by last access, oldest first) 
+  after the nodes at <moved> got a new, common access time. Gives the same 
+  result as sorting all nodes again, but only sorts <moved> together with 
+  the nodes whose access time is not earlier than theirs. 
+
+  INPUT: 
+    order: 1-D numpy array of node positions. 
+    moved: 1-D numpy array of the positions that were accessed. 
+    accessed: The datetime64 array of last access times, already updated. 
+    tie_keys: A tuple of arrays that order nodes with equal access times. 
+  OUTPUT: 
+    The new order (a 1-D numpy array). 
+  """
+  if not len(moved): 
+    return order
+  is_moved = numpy.zeros(len(order), dtype=bool)
+  is_moved[moved] = True
+  kept = order[~is_moved[order]]
+  start = numpy.searchsorted(accessed[kept], accessed[moved[0]], side="left")
+  tail = numpy.concatenate([kept[start:], moved])
+  tail = tail[numpy.lexsort(tuple(i[tail] for i in reversed(tie_keys)) 
+                            + (accessed[tail],))]
+  return numpy.concatenate([kept[:start], tail])
+
+
 def new_retrieve(persona, focal_points, n_count=30): 
   """
   Given the current persona and focal points (focal points are events or 
   thoughts for which we are retrieving), we retrieve a set of nodes for each
   of the focal points and return a dictionary. 
 
+  The candidate nodes, their importance and their relevance to all focal 
+  points are computed once for the whole batch. Only the recency order is 
+  updated between focal points, since retrieving a node refreshes its 
+  last_accessed. 
+
   INPUT: 
     persona: The current persona object whose memory we are retrieving. 
     focal_points: A list of focal points (string description of the events or
@@ -217,23 +362,55 @@ def new_retrieve(persona, focal_points, n_count=30):
   """
   # <retrieved> is the main dictionary that we are returning
   retrieved = dict() 
-  for focal_pt in focal_points: 
-    # Getting all nodes from the agent's memory (both thoughts and events) and
-    # sorting them by the datetime of creation.
-    # You could also imagine getting the raw conversation, but for now. 
-    nodes = [[i.last_accessed, i]
-              for i in persona.a_mem.seq_event + persona.a_mem.seq_thought
-              if "idle" not in i.embedding_key]
-    nodes = sorted(nodes, key=lambda x: x[0])
-    nodes = [i for created, i in nodes]
-
-    # Calculating the component dictionaries and normalizing them.
-    recency_out = extract_recency(persona, nodes)
-    recency_out = normalize_dict_floats(recency_out, 0, 1)
-    importance_out = extract_importance(persona, nodes)
-    importance_out = normalize_dict_floats(importance_out, 0, 1)  
-    relevance_out = extract_relevance(persona, nodes, focal_pt)
-    relevance_out = normalize_dict_floats(relevance_out, 0, 1)
+  # Focal points parsed from a model response can be an empty list. 
+  if not focal_points: 
+    return retrieved
+
+  # Getting all nodes from the agent's memory (both thoughts and events). 
+  # You could also imagine getting the raw conversation, but for now. 
+  # The memory keeps them sorted by last_accessed, so <nodes> comes least 
+  # recently accessed first and a node's position is its recency rank. 
+  nodes = persona.a_mem.get_recency_order()
+  if not nodes: 
+    for focal_pt in focal_points: 
+      retrieved[focal_pt] = []
+    return retrieved
+
+  # Calculating the component arrays and normalizing them. Position i of 
+  # each array belongs to nodes[i], except for <recency_by_rank>, which is 
+  # indexed by the rank of a node when sorted by last_accessed. 
+  accessed = numpy.array([i.last_accessed for i in nodes], 
+                         dtype="datetime64[us]")
+  tie_keys = (numpy.array([i.type == "thought" for i in nodes]), 
+              -numpy.array([i.node_count for i in nodes]))
+  recency_by_rank = extract_recency_array(persona, nodes)
+  recency_by_rank = normalize_array(recency_by_rank, 0, 1)
+  importance_out = extract_importance_array(persona, nodes)
+  importance_out = normalize_array(importance_out, 0, 1)  
+  use_ann = ann_retrieve and len(nodes) > ann_candidates
+  if use_ann: 
+    # The relevance is normalized within each candidate pool, so scores can
+    # differ slightly from exact retrieval. 
+    node_positions = {node.node_id: i for i, node in enumerate(nodes)}
+    focal_embeddings = get_embeddings(focal_points)
+    top_importance = top_x_indices(importance_out, n_count)
+    top_recency_ranks = top_x_indices(recency_by_rank, n_count)
+  else: 
+    relevance_all = extract_relevance_matrix(persona, nodes, focal_points)
+
+  # <order> holds the node positions by the datetime of their last access,
+  # oldest first. 
+  order = numpy.arange(len(nodes))
+  touched = []
+  for count, focal_pt in enumerate(focal_points): 
+    if use_ann: 
+      relevance_out = extract_relevance_candidates(
+        persona, nodes, node_positions, focal_embeddings[count], 
+        numpy.concatenate([order[top_recency_ranks], top_importance]))
+      in_pool = ~numpy.isnan(relevance_out)
+      relevance_out[in_pool] = normalize_array(relevance_out[in_pool], 0, 1)
+    else: 
+      relevance_out = normalize_array(relevance_all[count], 0, 1)
 
     # Computing the final scores that combines the component values. 
     # Note to self: test out different weights. [1, 1, 1] tends to work
@@ -242,43 +419,29 @@ def new_retrieve(persona, focal_points, n_count=30):
     # gw = [1, 1, 1]
     # gw = [1, 2, 1]
     gw = [0.5, 3, 2]
-    master_out = dict()
-    for key in recency_out.keys(): 
-      master_out[key] = (persona.scratch.recency_w*recency_out[key]*gw[0] 
-                     + persona.scratch.relevance_w*relevance_out[key]*gw[1] 
-                     + persona.scratch.importance_w*importance_out[key]*gw[2])
-
-    master_out = top_highest_x_values(master_out, len(master_out.keys()))
-    for key, val in master_out.items(): 
-      print (persona.a_mem.id_to_node[key].embedding_key, val)
-      print (persona.scratch.recency_w*recency_out[key]*1, 
-             persona.scratch.relevance_w*relevance_out[key]*1, 
-             persona.scratch.importance_w*importance_out[key]*1)
-
-    # Extracting the highest x values.
-    # <master_out> has the key of node.id and value of float. Once we get the 
-    # highest x values, we want to translate the node.id into nodes and return
-    # the list of nodes.
-    master_out = top_highest_x_values(master_out, n_count)
-    master_nodes = [persona.a_mem.id_to_node[key] 
-                    for key in list(master_out.keys())]
-
-    for n in master_nodes: 
-      n.last_accessed = persona.scratch.curr_time
+    master_out = (persona.scratch.recency_w*recency_by_rank*gw[0] 
+                  + persona.scratch.relevance_w*relevance_out[order]*gw[1] 
+                  + persona.scratch.importance_w*importance_out[order]*gw[2])
+    if use_ann: 
+      master_out[~in_pool[order]] = -numpy.inf
+
+    # Extracting the highest x values and translating them into nodes.
+    top_ranks = top_x_indices(master_out, n_count)
+    top_indices = order[top_ranks]
+    master_nodes = [nodes[i] for i in top_indices]
+
+    if debug: 
+      for rank, i in zip(top_ranks, top_indices): 
+        print (nodes[i].embedding_key, master_out[rank])
+        print (persona.scratch.recency_w*recency_by_rank[rank]*1, 
+               persona.scratch.relevance_w*relevance_out[i]*1, 
+               persona.scratch.importance_w*importance_out[i]*1)
+
+    touched += master_nodes
+    accessed[top_indices] = numpy.datetime64(persona.scratch.curr_time, "us")
+    order = update_recency_order(order, top_indices, accessed, tie_keys)
       
     retrieved[focal_pt] = master_nodes
 
+  persona.a_mem.touch(touched, persona.scratch.curr_time)
   return retrieved
-
-
-
-
-
-
-
-
-
-
-
-
-
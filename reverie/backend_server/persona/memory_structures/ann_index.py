@@ -0,0 +1,192 @@
+"""
+File: ann_index.py
+Description: An approximate nearest neighbour index (IVF-flat) over the
+embeddings of a persona's events and thoughts. The embeddings are clustered
+with k-means, and a query is only compared with the nodes in the <nprobe>
+clusters whose centroids are closest to it. Retrieval uses it to pick a
+candidate pool, which it then re-ranks with recency and importance.
+
+Run this file directly for a benchmark against exact search:
+  python ann_index.py [n_nodes] [dim]
+"""
+import sys
+sys.path.append('../../')
+
+import time
+import numpy
+
+# <ann_nprobe> is the recall/latency knob: the number of clusters searched
+# per query. More clusters find more of the true nearest neighbours, but
+# compare the query with more nodes.
+ann_nprobe = 8
+# The index is searched exhaustively until it holds <ann_min_train_size>
+# nodes. After that, the clusters are trained, and retrained every time the
+# index has doubled in size since the last training.
+ann_min_train_size = 512
+ann_kmeans_iterations = 10
+
+
+class IVFFlatIndex:
+  def __init__(self, nprobe=ann_nprobe):
+    self.nprobe = nprobe
+
+    # <nodes> holds the indexed nodes in the order they were added, and
+    # <node_to_row> maps a node_id to its row in <vectors>.
+    self.nodes = []
+    self.node_to_row = dict()
+    # <vectors> holds the unit-length embedding of every node, one float32 row
+    # each. Only the first len(self.nodes) rows are in use.
+    self.vectors = None
+
+    # <centroids> holds one unit-length row per cluster (None until the index
+    # is trained), and <lists> holds the rows of the nodes in each cluster.
+    self.centroids = None
+    self.lists = []
+    self.trained_size = 0
+
+
+  def __len__(self):
+    return len(self.nodes)
+
+
+  def dim(self):
+    if self.vectors is None:
+      return None
+    return self.vectors.shape[1]
+
+
+  def add(self, node, embedding):
+    """
+    Adds <node> with its <embedding> to the index.
+    """
+    vec = numpy.asarray(embedding, dtype=numpy.float32)
+    vec_norm = numpy.linalg.norm(vec)
+    if vec_norm:
+      vec = vec / vec_norm
+
+    row = len(self.nodes)
+    if self.vectors is None:
+      self.vectors = numpy.zeros((64, len(vec)), dtype=numpy.float32)
+    elif row == len(self.vectors):
+      vectors = numpy.zeros((2 * row, self.vectors.shape[1]),
+                            dtype=numpy.float32)
+      vectors[:row] = self.vectors
+      self.vectors = vectors
+    self.vectors[row] = vec
+    self.nodes += [node]
+    self.node_to_row[node.node_id] = row
+
+    if len(self.nodes) >= max(ann_min_train_size, 2 * self.trained_size):
+      self.train()
+    elif self.centroids is not None:
+      self.lists[int(numpy.argmax(self.centroids @ vec))].append(row)
+
+
+  def train(self):
+    """
+    Clusters the indexed vectors with spherical k-means (about sqrt(n)
+    clusters), and rebuilds the cluster lists.
+    """
+    vectors = self.vectors[:len(self.nodes)]
+    n_lists = max(1, min(1024, int(len(vectors) ** 0.5)))
+    rng = numpy.random.RandomState(0)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+
+    for i in range(ann_kmeans_iterations):
+      assignment = numpy.argmax(vectors @ centroids.T, axis=1)
+      sums = numpy.zeros_like(centroids)
+      numpy.add.at(sums, assignment, vectors)
+      sum_norms = numpy.linalg.norm(sums, axis=1, keepdims=True)
+      # Empty clusters keep their old centroid.
+      filled = sum_norms[:, 0] > 0
+      centroids[filled] = sums[filled] / sum_norms[filled]
+
+    assignment = numpy.argmax(vectors @ centroids.T, axis=1)
+    self.centroids = centroids
+    self.lists = [[] for i in range(n_lists)]
+    for row, cluster in enumerate(assignment):
+      self.lists[cluster].append(row)
+    self.trained_size = len(vectors)
+
+
+  def search(self, query, k, nprobe=None):
+    """
+    Finds (approximately) the <k> indexed nodes most similar to <query>.
+
+    INPUT
+      query: The query embedding.
+      k: The number of rows to return.
+      nprobe: The number of clusters to search (defaults to self.nprobe).
+    OUTPUT
+      A numpy array of at most <k> rows (see self.nodes), most similar first.
+    """
+    if not self.nodes:
+      return numpy.zeros(0, dtype=int)
+    query = numpy.asarray(query, dtype=numpy.float32)
+    if self.centroids is None:
+      rows = numpy.arange(len(self.nodes))
+    else:
+      nprobe = min(nprobe or self.nprobe, len(self.centroids))
+      cluster_sims = self.centroids @ query
+      probed = numpy.argpartition(-cluster_sims, nprobe - 1)[:nprobe]
+      rows = numpy.fromiter((row for cluster in probed
+                                 for row in self.lists[cluster]), dtype=int)
+    sims = self.vectors[rows] @ query
+    if k < len(rows):
+      top = numpy.argpartition(-sims, k - 1)[:k]
+      rows, sims = rows[top], sims[top]
+    return rows[numpy.argsort(-sims, kind="stable")]
+
+
+  def similarities(self, query, rows):
+    """
+    Exact cosine similarity of <query> to the nodes in <rows>.
+    """
+    query = numpy.asarray(query, dtype=numpy.float32)
+    query_norm = numpy.linalg.norm(query)
+    if query_norm:
+      query = query / query_norm
+    return self.vectors[rows] @ query
+
+
+def benchmark(n_nodes=20000, dim=384, n_queries=100, k=100):
+  """
+  Compares the top <k> of the index with exact search on clustered random
+  data, for a few settings of nprobe.
+  """
+  class BenchmarkNode:
+    def __init__(self, node_id):
+      self.node_id = node_id
+
+  rng = numpy.random.RandomState(1)
+  topics = rng.randn(200, dim)
+  data = (topics[rng.randint(0, 200, n_nodes)]
+          + 0.5 * rng.randn(n_nodes, dim)).astype(numpy.float32)
+  queries = (topics[rng.randint(0, 200, n_queries)]
+             + 0.5 * rng.randn(n_queries, dim)).astype(numpy.float32)
+  queries /= numpy.linalg.norm(queries, axis=1, keepdims=True)
+
+  start = time.time()
+  index = IVFFlatIndex()
+  for count, vec in enumerate(data):
+    index.add(BenchmarkNode(f"node_{count + 1}"), vec)
+  print (f"indexed {n_nodes} x {dim} in {time.time() - start:.2f}s "
+         f"({len(index.centroids)} clusters)")
+
+  vectors = index.vectors[:n_nodes]
+  start = time.time()
+  exact = [set(numpy.argpartition(-(vectors @ q), k - 1)[:k]) for q in queries]
+  exact_ms = (time.time() - start) * 1000 / n_queries
+  print (f"exact: {exact_ms:.2f} ms/query")
+
+  for nprobe in [1, 4, 8, 16, 32]:
+    start = time.time()
+    found = [index.search(q, k, nprobe) for q in queries]
+    ann_ms = (time.time() - start) * 1000 / n_queries
+    recall = numpy.mean([len(exact[i] & set(found[i])) / k
+                         for i in range(n_queries)])
+    print (f"nprobe={nprobe}: {ann_ms:.2f} ms/query, recall@{k}={recall:.3f}")
+
+
+if __name__ == '__main__':
+  benchmark(*[int(i) for i in sys.argv[1:3]])
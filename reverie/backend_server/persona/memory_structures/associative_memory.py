@@ -12,11 +12,54 @@ sys.path.append('../../')
 
 import json
 import datetime
+import os
+from collections import OrderedDict
 
 from global_methods import *
+from persona.memory_structures.embedding_store import *
+from persona.memory_structures.ann_index import *
+from persona.prompt_template.gpt_structure import get_embeddings
+
+# Every node added to an associative memory is also appended to journal.jsonl
+# in its folder as soon as it is created. Loading replays the journal on top
+# of the snapshot (nodes.json, kw_strength.json and the embeddings), so 
+# saving only needs to rewrite the snapshot once the journal grows past 
+# <journal_compact_threshold> records (or when asked to compact). 
+# The rest of a persona's state (scratch.json) and the simulation meta are 
+# checkpointed after every step (see ReverieServer.checkpoint). Records of a
+# step that was never checkpointed are dropped on load, since the server 
+# runs that step again. 
+journal_compact_threshold = 2000
+
+
+def intern_str(value): 
+  """
+  Interns <value> if it is a string, so that the many nodes repeating the 
+  same subject, predicate, object or keyword share one string object. 
+  """
+  if type(value) is str: 
+    return sys.intern(value)
+  return value
+
+
+def recency_key(node): 
+  """
+  The key the recency index sorts nodes by: their last_accessed time, with 
+  ties in the order of seq_event + seq_thought (events before thoughts, 
+  newest first). 
+  """
+  return (node.last_accessed, node.type == "thought", -node.node_count)
 
 
 class ConceptNode: 
+  # Every persona keeps all of its nodes resident for the whole run, so nodes
+  # use slots instead of a per-instance __dict__. 
+  __slots__ = ("node_id", "node_count", "type_count", "type", "depth", 
+               "created", "expiration", "last_accessed", 
+               "subject", "predicate", "object", 
+               "description", "embedding_key", "poignancy", "keywords", 
+               "filling", "idle")
+
   def __init__(self,
                node_id, node_count, type_count, node_type, depth,
                created, expiration, 
@@ -25,21 +68,23 @@ class ConceptNode:
     self.node_id = node_id
     self.node_count = node_count
     self.type_count = type_count
-    self.type = node_type # thought / event / chat
+    self.type = intern_str(node_type) # thought / event / chat
     self.depth = depth
 
     self.created = created
     self.expiration = expiration
     self.last_accessed = self.created
 
-    self.subject = s
-    self.predicate = p
-    self.object = o
+    self.subject = intern_str(s)
+    self.predicate = intern_str(p)
+    self.object = intern_str(o)
 
-    self.description = description
-    self.embedding_key = embedding_key
+    self.description = intern_str(description)
+    self.embedding_key = intern_str(embedding_key)
+    # Retrieval and reflection skip the "is idle" nodes. 
+    self.idle = "idle" in embedding_key
     self.poignancy = poignancy
-    self.keywords = keywords
+    self.keywords = set(intern_str(i) for i in keywords)
     self.filling = filling
 
 
@@ -47,13 +92,98 @@ class ConceptNode:
     return (self.subject, self.predicate, self.object)
 
 
+class MemoryStream: 
+  """
+  A sequence of nodes that reads newest first, just like the lists the 
+  memory used to prepend new nodes to (so stream[0] is the latest node and 
+  stream[:retention] the latest <retention> nodes). Internally the nodes are
+  kept oldest first, so that adding a node is an O(1) append instead of an 
+  O(n) insert at the front. 
+
+  Indexing, slicing (slices return lists), iteration, len, "+" and "==" 
+  behave like they do on the equivalent newest-first list. 
+  """
+  def __init__(self, nodes=None): 
+    # <nodes> is given newest first, like the stream reads. 
+    self.nodes = []
+    if nodes: 
+      self.nodes = list(reversed(nodes))
+
+
+  def prepend(self, node): 
+    """
+    Adds <node> as the newest node of the stream. 
+    """
+    self.nodes.append(node)
+
+
+  def __len__(self): 
+    return len(self.nodes)
+
+
+  def __iter__(self): 
+    return reversed(self.nodes)
+
+
+  def __reversed__(self): 
+    return iter(self.nodes)
+
+
+  def __getitem__(self, index): 
+    n_nodes = len(self.nodes)
+    if isinstance(index, slice): 
+      start, stop, step = index.indices(n_nodes)
+      if step == 1: 
+        if start >= stop: 
+          return []
+        return self.nodes[n_nodes - stop:n_nodes - start][::-1]
+      return [self.nodes[n_nodes - 1 - i] for i in range(start, stop, step)]
+    if index < 0: 
+      index += n_nodes
+    if not 0 <= index < n_nodes: 
+      raise IndexError("MemoryStream index out of range")
+    return self.nodes[n_nodes - 1 - index]
+
+
+  def __add__(self, other): 
+    return list(self) + list(other)
+
+
+  def __radd__(self, other): 
+    return list(other) + list(self)
+
+
+  def __eq__(self, other): 
+    if isinstance(other, (list, MemoryStream)): 
+      return list(self) == list(other)
+    return NotImplemented
+
+
+  def __repr__(self): 
+    return f"MemoryStream({list(self)!r})"
+
+
 class AssociativeMemory: 
-  def __init__(self, f_saved): 
+  def __init__(self, f_saved, resume_time=None, read_only=False): 
+    """
+    Loads the memory saved in the <f_saved> folder. 
+
+    INPUT: 
+      f_saved: the associative_memory folder of a persona. 
+      resume_time: the time the simulation resumes at (the curr_time of 
+                   reverie/meta.json). Journal records created at or after 
+                   it are not loaded. None loads every record. 
+      read_only: if True, the folder is never written to: new nodes are not
+                 journaled, and a torn or dropped tail of the journal is 
+                 left in place. 
+    """
     self.id_to_node = dict()
 
-    self.seq_event = []
-    self.seq_thought = []
-    self.seq_chat = []
+    # The memory streams and keyword indexes are <MemoryStream>s, which read
+    # newest first. 
+    self.seq_event = MemoryStream()
+    self.seq_thought = MemoryStream()
+    self.seq_chat = MemoryStream()
 
     self.kw_to_event = dict()
     self.kw_to_thought = dict()
@@ -62,45 +192,31 @@ class AssociativeMemory:
     self.kw_strength_event = dict()
     self.kw_strength_thought = dict()
 
-    self.embeddings = json.load(open(f_saved + "/embeddings.json"))
+    # <embeddings> maps an embedding key (the embedded string) to its 
+    # embedding. It is an EmbeddingStore, which keeps all embeddings in one 
+    # float32 matrix so that retrieval can score them in a single product. 
+    # If the embedding model changes, the store embeds its keys again with 
+    # get_embeddings. 
+    self.embeddings = EmbeddingStore.load(f_saved, get_embeddings)
+    # <ann_index> is an approximate nearest neighbour index over the events 
+    # and thoughts (see get_ann_index). 
+    self.ann_index = None
+    # <recency_index> holds the non-idle events and thoughts by node_id, 
+    # least recently accessed first (see get_recency_order). 
+    self.recency_index = None
+
+    # <journal_file> is where new nodes are appended. It stays None while 
+    # we are loading, since those nodes are already on disk. 
+    # <journal_records> counts the records in the journal. 
+    self.f_saved = f_saved
+    self.read_only = read_only
+    self.journal_file = None
+    self.journal_records = 0
 
     nodes_load = json.load(open(f_saved + "/nodes.json"))
     for count in range(len(nodes_load.keys())): 
       node_id = f"node_{str(count+1)}"
-      node_details = nodes_load[node_id]
-
-      node_count = node_details["node_count"]
-      type_count = node_details["type_count"]
-      node_type = node_details["type"]
-      depth = node_details["depth"]
-
-      created = datetime.datetime.strptime(node_details["created"], 
-                                           '%Y-%m-%d %H:%M:%S')
-      expiration = None
-      if node_details["expiration"]: 
-        expiration = datetime.datetime.strptime(node_details["expiration"],
-                                                '%Y-%m-%d %H:%M:%S')
-
-      s = node_details["subject"]
-      p = node_details["predicate"]
-      o = node_details["object"]
-
-      description = node_details["description"]
-      embedding_pair = (node_details["embedding_key"], 
-                        self.embeddings[node_details["embedding_key"]])
-      poignancy =node_details["poignancy"]
-      keywords = set(node_details["keywords"])
-      filling = node_details["filling"]
-      
-      if node_type == "event": 
-        self.add_event(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
-      elif node_type == "chat": 
-        self.add_chat(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
-      elif node_type == "thought": 
-        self.add_thought(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
+      self.load_node(nodes_load[node_id])
 
     kw_strength_load = json.load(open(f_saved + "/kw_strength.json"))
     if kw_strength_load["kw_strength_event"]: 
@@ -108,46 +224,276 @@ class AssociativeMemory:
     if kw_strength_load["kw_strength_thought"]: 
       self.kw_strength_thought = kw_strength_load["kw_strength_thought"]
 
+    self.replay_journal(f_saved + "/journal.jsonl", resume_time)
+    if not read_only: 
+      self.journal_file = f_saved + "/journal.jsonl"
+
+
+  def load_node(self, node_details): 
+    """
+    Adds a node from its saved form (an entry of nodes.json, or a journal 
+    record) to the memory. 
+    """
+    created = datetime.datetime.strptime(node_details["created"], 
+                                         '%Y-%m-%d %H:%M:%S')
+    expiration = None
+    if node_details["expiration"]: 
+      expiration = datetime.datetime.strptime(node_details["expiration"],
+                                              '%Y-%m-%d %H:%M:%S')
+
+    s = node_details["subject"]
+    p = node_details["predicate"]
+    o = node_details["object"]
+
+    description = node_details["description"]
+    embedding_pair = (node_details["embedding_key"], 
+                      self.embeddings[node_details["embedding_key"]])
+    poignancy =node_details["poignancy"]
+    keywords = set(node_details["keywords"])
+    filling = node_details["filling"]
     
-  def save(self, out_json): 
+    node_type = node_details["type"]
+    if node_type == "event": 
+      self.add_event(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+    elif node_type == "chat": 
+      self.add_chat(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+    elif node_type == "thought": 
+      self.add_thought(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+
+
+  def replay_journal(self, journal_file, resume_time=None): 
+    """
+    Adds the nodes recorded in <journal_file> that are not in the snapshot 
+    yet. A record that was only partly written (e.g., the server was killed 
+    mid-write) ends the replay, and so does the first record created at or 
+    after <resume_time>: it belongs to a step that was never checkpointed, 
+    and so does every record after it. Unless the memory is read only, that
+    tail is cut off the file, so that new records are appended after the 
+    last good one. 
+    """
+    if not check_if_file_exists(journal_file): 
+      return
+
+    good_bytes = 0
+    with open(journal_file, "rb") as infile: 
+      for line in infile: 
+        if not line.endswith(b"\n"): 
+          break
+        try: 
+          record = json.loads(line)
+        except ValueError: 
+          break
+        if (resume_time is not None 
+            and datetime.datetime.strptime(record["created"], 
+                                           '%Y-%m-%d %H:%M:%S') 
+                >= resume_time): 
+          break
+        good_bytes += len(line)
+        self.journal_records += 1
+
+        # Records of nodes that are already in the snapshot are left over 
+        # from a compaction that was interrupted. 
+        if record["node_id"] in self.id_to_node: 
+          continue
+        if record["embedding"] is not None: 
+          self.embeddings[record["embedding_key"]] = record["embedding"]
+        self.load_node(record)
+
+    if not self.read_only and good_bytes < os.path.getsize(journal_file): 
+      os.truncate(journal_file, good_bytes)
+
+
+  def node_to_dict(self, node): 
+    """
+    Returns the saved form of <node>, as stored in nodes.json. 
+    """
+    r = dict()
+    r["node_count"] = node.node_count
+    r["type_count"] = node.type_count
+    r["type"] = node.type
+    r["depth"] = node.depth
+
+    r["created"] = node.created.strftime('%Y-%m-%d %H:%M:%S')
+    r["expiration"] = None
+    if node.expiration: 
+      r["expiration"] = node.expiration.strftime('%Y-%m-%d %H:%M:%S')
+
+    r["subject"] = node.subject
+    r["predicate"] = node.predicate
+    r["object"] = node.object
+
+    r["description"] = node.description
+    r["embedding_key"] = node.embedding_key
+    r["poignancy"] = node.poignancy
+    r["keywords"] = list(node.keywords)
+    r["filling"] = node.filling
+    return r
+
+
+  def add_node_embedding(self, node, embedding_pair): 
+    """
+    Stores the embedding of a newly added <node>, and appends the node to 
+    the journal. The embedding itself is only journaled if its key is new. 
+    """
+    new_key = embedding_pair[0] not in self.embeddings
+    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+
+    if not self.journal_file: 
+      return
+    record = self.node_to_dict(node)
+    record["node_id"] = node.node_id
+    record["embedding"] = None
+    if new_key: 
+      record["embedding"] = [float(i) for i in embedding_pair[1]]
+    with open(self.journal_file, "a", encoding="utf-8") as outfile: 
+      outfile.write(json.dumps(record) + "\n")
+    self.journal_records += 1
+
+    
+  def get_ann_index(self): 
+    """
+    Returns the <IVFFlatIndex> over the embeddings of the events and 
+    thoughts that retrieval considers (i.e., the non-idle ones). It is built
+    on first use, and kept up to date by add_event and add_thought after 
+    that. 
+    """
+    if self.ann_index is not None: 
+      if self.ann_index.dim() not in (None, 
+                                      self.embeddings.get_matrix().shape[1]): 
+        self.ann_index = None
+    if self.ann_index is None: 
+      self.ann_index = IVFFlatIndex()
+      for node in reversed(list(self.seq_event) + list(self.seq_thought)): 
+        if not node.idle: 
+          self.add_to_ann_index(node)
+    return self.ann_index
+
+
+  def get_recency_order(self): 
+    """
+    Returns the non-idle events and thoughts sorted by recency_key, least 
+    recently accessed first. The order is kept up to date by add_event, 
+    add_thought and touch, so it is only sorted once, on first use. 
+    """
+    if self.recency_index is None: 
+      nodes = [i for i in list(self.seq_event) + list(self.seq_thought) 
+               if not i.idle]
+      self.recency_index = OrderedDict((i.node_id, i) 
+                                       for i in sorted(nodes, key=recency_key))
+    return list(self.recency_index.values())
+
+
+  def get_latest_accessed(self, n): 
+    """
+    Returns the <n> most recently accessed non-idle events and thoughts, 
+    least recently accessed first. Only walks those <n> nodes. 
+    """
+    if self.recency_index is None: 
+      self.get_recency_order()
+    latest = []
+    for node_id in reversed(self.recency_index): 
+      if len(latest) == n: 
+        break
+      latest += [self.recency_index[node_id]]
+    return latest[::-1]
+
+
+  def touch(self, nodes, curr_time): 
+    """
+    Sets the last_accessed time of the retrieved <nodes> to <curr_time>, and
+    moves them to their new place in the recency index. 
+    """
+    for node in nodes: 
+      node.last_accessed = curr_time
+    if self.recency_index is None: 
+      return
+    for node in nodes: 
+      self.recency_index.pop(node.node_id, None)
+    for node in sorted(nodes, key=recency_key): 
+      if not node.idle: 
+        self.place_in_recency_index(node)
+
+
+  def place_in_recency_index(self, node): 
+    # Nodes usually go at (or very near) the end, so we only move the nodes 
+    # that sort after <node>. 
+    key = recency_key(node)
+    after = []
+    while self.recency_index: 
+      last_id = next(reversed(self.recency_index))
+      if recency_key(self.recency_index[last_id]) <= key: 
+        break
+      after += [self.recency_index.pop(last_id)]
+    self.recency_index[node.node_id] = node
+    for i in reversed(after): 
+      self.recency_index[i.node_id] = i
+
+
+  def index_node(self, node): 
+    """
+    Adds a new event or thought to the indexes that have been built. 
+    """
+    if node.idle: 
+      return
+    if self.recency_index is not None: 
+      self.place_in_recency_index(node)
+    if self.ann_index is not None: 
+      self.add_to_ann_index(node)
+
+
+  def add_to_ann_index(self, node): 
+    embedding = self.embeddings[node.embedding_key]
+    if self.ann_index.dim() not in (None, len(embedding)): 
+      # The embedding model changed (see EmbeddingStore._reencode), so 
+      # the index is rebuilt from the store on its next use. 
+      self.ann_index = None
+      return
+    self.ann_index.add(node, embedding)
+
+
+  def save(self, out_json, compact=False): 
+    """
+    Saves the memory to the <out_json> folder. If that is the folder the 
+    memory is journaling to, all nodes are already on disk, and we only 
+    rewrite the snapshot (and empty the journal) if <compact> is set or the 
+    journal has grown past <journal_compact_threshold>. Any other folder 
+    gets a full snapshot. 
+    """
+    same_folder = (self.journal_file is not None 
+                   and os.path.realpath(out_json) 
+                       == os.path.realpath(self.f_saved))
+    if (same_folder and not compact 
+        and self.journal_records < journal_compact_threshold): 
+      return
+
+    # The embeddings go first, since journal records only carry the 
+    # embeddings that were new. Each file is replaced in one step, so a 
+    # crash leaves either the old or the new version of it. 
+    self.embeddings.save(out_json)
+
     r = dict()
     for count in range(len(self.id_to_node.keys()), 0, -1): 
       node_id = f"node_{str(count)}"
-      node = self.id_to_node[node_id]
-
-      r[node_id] = dict()
-      r[node_id]["node_count"] = node.node_count
-      r[node_id]["type_count"] = node.type_count
-      r[node_id]["type"] = node.type
-      r[node_id]["depth"] = node.depth
-
-      r[node_id]["created"] = node.created.strftime('%Y-%m-%d %H:%M:%S')
-      r[node_id]["expiration"] = None
-      if node.expiration: 
-        r[node_id]["expiration"] = (node.expiration
-                                        .strftime('%Y-%m-%d %H:%M:%S'))
-
-      r[node_id]["subject"] = node.subject
-      r[node_id]["predicate"] = node.predicate
-      r[node_id]["object"] = node.object
-
-      r[node_id]["description"] = node.description
-      r[node_id]["embedding_key"] = node.embedding_key
-      r[node_id]["poignancy"] = node.poignancy
-      r[node_id]["keywords"] = list(node.keywords)
-      r[node_id]["filling"] = node.filling
-
-    with open(out_json+"/nodes.json", "w") as outfile:
+      r[node_id] = self.node_to_dict(self.id_to_node[node_id])
+    with open(out_json+"/nodes.json.tmp", "w") as outfile:
       json.dump(r, outfile)
+    os.replace(out_json+"/nodes.json.tmp", out_json+"/nodes.json")
 
     r = dict()
     r["kw_strength_event"] = self.kw_strength_event
     r["kw_strength_thought"] = self.kw_strength_thought
-    with open(out_json+"/kw_strength.json", "w") as outfile:
+    with open(out_json+"/kw_strength.json.tmp", "w") as outfile:
       json.dump(r, outfile)
+    os.replace(out_json+"/kw_strength.json.tmp", out_json+"/kw_strength.json")
 
-    with open(out_json+"/embeddings.json", "w") as outfile:
-      json.dump(self.embeddings, outfile)
+    # The snapshot now holds every node, so the journal in that folder (ours,
+    # or one left over in a folder we are saving into) is emptied. 
+    open(out_json+"/journal.jsonl", "w").close()
+    if same_folder: 
+      self.journal_records = 0
 
 
   def add_event(self, created, expiration, s, p, o, 
@@ -174,13 +520,13 @@ class AssociativeMemory:
                        poignancy, keywords, filling)
 
     # Creating various dictionary cache for fast access. 
-    self.seq_event[0:0] = [node]
-    keywords = [i.lower() for i in keywords]
+    self.seq_event.prepend(node)
+    keywords = [intern_str(i.lower()) for i in keywords]
     for kw in keywords: 
       if kw in self.kw_to_event: 
-        self.kw_to_event[kw][0:0] = [node]
+        self.kw_to_event[kw].prepend(node)
       else: 
-        self.kw_to_event[kw] = [node]
+        self.kw_to_event[kw] = MemoryStream([node])
     self.id_to_node[node_id] = node 
 
     # Adding in the kw_strength
@@ -191,7 +537,8 @@ class AssociativeMemory:
         else: 
           self.kw_strength_event[kw] = 1
 
-    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.add_node_embedding(node, embedding_pair)
+    self.index_node(node)
 
     return node
 
@@ -218,13 +565,13 @@ class AssociativeMemory:
                        description, embedding_pair[0], poignancy, keywords, filling)
 
     # Creating various dictionary cache for fast access. 
-    self.seq_thought[0:0] = [node]
-    keywords = [i.lower() for i in keywords]
+    self.seq_thought.prepend(node)
+    keywords = [intern_str(i.lower()) for i in keywords]
     for kw in keywords: 
       if kw in self.kw_to_thought: 
-        self.kw_to_thought[kw][0:0] = [node]
+        self.kw_to_thought[kw].prepend(node)
       else: 
-        self.kw_to_thought[kw] = [node]
+        self.kw_to_thought[kw] = MemoryStream([node])
     self.id_to_node[node_id] = node 
 
     # Adding in the kw_strength
@@ -235,7 +582,8 @@ class AssociativeMemory:
         else: 
           self.kw_strength_thought[kw] = 1
 
-    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.add_node_embedding(node, embedding_pair)
+    self.index_node(node)
 
     return node
 
@@ -257,16 +605,16 @@ class AssociativeMemory:
                        description, embedding_pair[0], poignancy, keywords, filling)
 
     # Creating various dictionary cache for fast access. 
-    self.seq_chat[0:0] = [node]
-    keywords = [i.lower() for i in keywords]
+    self.seq_chat.prepend(node)
+    keywords = [intern_str(i.lower()) for i in keywords]
     for kw in keywords: 
       if kw in self.kw_to_chat: 
-        self.kw_to_chat[kw][0:0] = [node]
+        self.kw_to_chat[kw].prepend(node)
       else: 
-        self.kw_to_chat[kw] = [node]
+        self.kw_to_chat[kw] = MemoryStream([node])
     self.id_to_node[node_id] = node 
 
-    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.add_node_embedding(node, embedding_pair)
         
     return node
 
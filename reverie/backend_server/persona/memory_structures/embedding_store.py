@@ -0,0 +1,245 @@
+"""
+File: embedding_store.py
+Description: Defines the EmbeddingStore, the columnar storage behind
+AssociativeMemory.embeddings. Embeddings are kept as rows of one float32
+matrix with a key -> row index, and are saved as a .npy file (memory-mapped
+when loaded) next to a small json file with the keys.
+"""
+import sys
+sys.path.append('../../')
+
+import json
+import os
+import numpy
+
+from global_methods import *
+
+
+class EmbeddingStore:
+  def __init__(self, encoder=None):
+    # <keys_list> holds the embedding keys (i.e., the embedded strings) in row
+    # order, and <key_to_row> is its reverse index.
+    self.keys_list = []
+    self.key_to_row = dict()
+
+    # <matrix> holds one float32 embedding per row. Only the first
+    # len(self.keys_list) rows are in use; the matrix grows by doubling.
+    # Right after loading, it is a read-only memory map of the .npy file,
+    # which is copied into memory on the first write.
+    self.matrix = None
+    # <norms> holds the L2 norm of every row, for cosine similarity.
+    self.norms = None
+    # <encoder> embeds a list of keys with the current embedding model (e.g.,
+    # gpt_structure.get_embeddings). It is only used when the embedding size
+    # changes (see _reencode).
+    self.encoder = encoder
+
+
+  @classmethod
+  def load(cls, folder, encoder=None):
+    """
+    Loads the embeddings saved in <folder>. Reads embeddings.npy and
+    embedding_keys.json if they are there, and falls back to the legacy
+    embeddings.json (a dictionary of key -> list of floats) otherwise.
+
+    INPUT
+      folder: The associative memory folder of a persona.
+      encoder: See __init__.
+    OUTPUT
+      An EmbeddingStore instance.
+    """
+    store = cls(encoder)
+    if (check_if_file_exists(f"{folder}/embeddings.npy")
+        and check_if_file_exists(f"{folder}/embedding_keys.json")):
+      keys = json.load(open(f"{folder}/embedding_keys.json"))
+      matrix = numpy.load(f"{folder}/embeddings.npy", mmap_mode="r")
+      if len(keys):
+        store.keys_list = keys
+        store.key_to_row = {key: row for row, key in enumerate(keys)}
+        store.matrix = matrix
+        store.norms = numpy.linalg.norm(matrix, axis=1).astype(numpy.float32)
+    elif check_if_file_exists(f"{folder}/embeddings.json"):
+      for key, val in json.load(open(f"{folder}/embeddings.json")).items():
+        store[key] = val
+    return store
+
+
+  def save(self, folder):
+    """
+    Saves the store as embeddings.npy and embedding_keys.json in <folder>.
+    The files are written under temporary names and then moved into place,
+    so that an interrupted save leaves the previous files intact.
+    """
+    # The store may still be a memory map of the embeddings.npy that is about
+    # to be replaced (see load), which can not be replaced while it is open
+    # on some platforms. The rows are read into memory first.
+    if isinstance(self.matrix, numpy.memmap):
+      self.matrix = numpy.array(self.matrix)
+
+    n_rows = len(self.keys_list)
+    matrix = self.get_matrix()
+    if n_rows == 0:
+      matrix = numpy.zeros((0, 0), dtype=numpy.float32)
+
+    tmp_npy = f"{folder}/embeddings.{os.getpid()}.tmp.npy"
+    numpy.save(tmp_npy, matrix)
+    os.replace(tmp_npy, f"{folder}/embeddings.npy")
+
+    tmp_keys = f"{folder}/embedding_keys.{os.getpid()}.tmp.json"
+    with open(tmp_keys, "w") as outfile:
+      json.dump(self.keys_list, outfile)
+    os.replace(tmp_keys, f"{folder}/embedding_keys.json")
+
+
+  def _reserve(self, n_rows, dim):
+    """
+    Makes sure the matrix is writable and has room for <n_rows> rows.
+    """
+    if self.matrix is None:
+      self.matrix = numpy.zeros((max(64, n_rows), dim), dtype=numpy.float32)
+      self.norms = numpy.zeros(len(self.matrix), dtype=numpy.float32)
+      return
+    if n_rows <= len(self.matrix) and self.matrix.flags.writeable:
+      return
+
+    capacity = len(self.matrix)
+    if n_rows > capacity:
+      capacity = max(n_rows, 2 * capacity)
+    in_use = len(self.keys_list)
+    matrix = numpy.zeros((capacity, self.matrix.shape[1]), dtype=numpy.float32)
+    matrix[:in_use] = self.matrix[:in_use]
+    norms = numpy.zeros(capacity, dtype=numpy.float32)
+    norms[:in_use] = self.norms[:in_use]
+    self.matrix = matrix
+    self.norms = norms
+
+
+  def _reencode(self, key, vec):
+    """
+    Called when <vec>, the new embedding of <key>, is not the size of the
+    stored embeddings. The two come from different embedding models (e.g.,
+    the bootstrap memories were embedded with a 1536-d model) and can not be
+    compared, so the ones that are not from the current model (the one
+    behind <encoder>) are embedded again: either <key> alone, or every key
+    in the store.
+
+    OUTPUT
+      The embedding to store for <key>.
+    """
+    if self.encoder is None:
+      raise ValueError(f"embedding of size {len(vec)} does not match the "
+                       f"stored embeddings of size {self.matrix.shape[1]}")
+    curr_vec = numpy.asarray(self.encoder([key])[0], dtype=numpy.float32)
+    if len(curr_vec) == self.matrix.shape[1]:
+      return curr_vec
+
+    keys = list(self.keys_list)
+    print (f"EmbeddingStore: embedding size changed "
+           f"({self.matrix.shape[1]} -> {len(curr_vec)}); re-embedding "
+           f"{len(keys)} stored keys.")
+    embeddings = self.encoder(keys)
+    self.keys_list = []
+    self.key_to_row = dict()
+    self.matrix = None
+    self.norms = None
+    for old_key, embedding in zip(keys, embeddings):
+      self[old_key] = embedding
+    return curr_vec
+
+
+  def __setitem__(self, key, embedding):
+    vec = numpy.asarray(embedding, dtype=numpy.float32)
+    if self.matrix is not None and self.matrix.shape[1] != len(vec):
+      if self.keys_list:
+        vec = self._reencode(key, vec)
+      else:
+        self.matrix = None
+        self.norms = None
+    if key in self.key_to_row:
+      row = self.key_to_row[key]
+      # Loading a memory writes back every embedding it just read. Skipping
+      # unchanged rows keeps a freshly loaded matrix memory-mapped.
+      if numpy.array_equal(self.matrix[row], vec):
+        return
+      self._reserve(len(self.keys_list), len(vec))
+    else:
+      row = len(self.keys_list)
+      self._reserve(row + 1, len(vec))
+      self.keys_list.append(key)
+      self.key_to_row[key] = row
+    self.matrix[row] = vec
+    self.norms[row] = numpy.linalg.norm(vec)
+
+
+  def __getitem__(self, key):
+    return self.matrix[self.key_to_row[key]].copy()
+
+
+  def __contains__(self, key):
+    return key in self.key_to_row
+
+
+  def __len__(self):
+    return len(self.keys_list)
+
+
+  def __iter__(self):
+    return iter(self.keys_list)
+
+
+  def get(self, key, default=None):
+    if key in self.key_to_row:
+      return self[key]
+    return default
+
+
+  def keys(self):
+    return list(self.keys_list)
+
+
+  def items(self):
+    for key in self.keys_list:
+      yield key, self[key]
+
+
+  def row(self, key):
+    """
+    Returns the matrix row that holds the embedding of <key>.
+    """
+    return self.key_to_row[key]
+
+
+  def get_matrix(self):
+    """
+    Returns the rows of the matrix that are in use (a view, not a copy).
+    """
+    if self.matrix is None:
+      return numpy.zeros((0, 0), dtype=numpy.float32)
+    return self.matrix[:len(self.keys_list)]
+
+
+  def get_norms(self):
+    """
+    Returns the L2 norms of the rows that are in use.
+    """
+    if self.norms is None:
+      return numpy.zeros(0, dtype=numpy.float32)
+    return self.norms[:len(self.keys_list)]
+
+
+  def cosine_similarities(self, queries):
+    """
+    Cosine similarity of every stored embedding to every query.
+
+    INPUT
+      queries: A 2-D array of shape (n_queries, dim).
+    OUTPUT
+      A numpy array of shape (n_queries, len(self)). Rows or queries with a
+      zero norm get a similarity of 0.
+    """
+    queries = numpy.asarray(queries, dtype=numpy.float32)
+    query_norms = numpy.linalg.norm(queries, axis=1, keepdims=True)
+    query_norms[query_norms == 0] = 1
+    row_norms = self.get_norms().copy()
+    row_norms[row_norms == 0] = 1
+    return (queries / query_norms) @ self.get_matrix().T / row_norms
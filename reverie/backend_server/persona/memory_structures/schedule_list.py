@@ -0,0 +1,149 @@
+"""
+File: schedule_list.py
+Description: A list of [task, duration] rows (e.g., f_daily_schedule) that
+keeps the cumulative durations of its rows, so that finding the row going
+on at a given minute of the day is a bisect instead of a walk over the
+whole schedule. The sums are rebuilt on the first lookup after the list is
+edited through any list method (slice assignment, +=, insert, ...).
+"""
+import bisect
+
+
+class ScheduleList(list):
+  def __init__(self, rows=()):
+    super().__init__(rows)
+    # <cumulative> holds the minute at which each row starts, followed by the
+    # total: [0, d_0, d_0 + d_1, ..., sum of all durations]. None when the
+    # list was edited since it was built.
+    self.cumulative = None
+    # <monotonic> is False if a row has a negative duration, in which case
+    # the cumulative durations cannot be bisected.
+    self.monotonic = True
+
+
+  def invalidate(self):
+    self.cumulative = None
+
+
+  def build(self):
+    cumulative = [0]
+    for task, duration in self:
+      cumulative += [cumulative[-1] + duration]
+    self.monotonic = all(cumulative[i] <= cumulative[i + 1]
+                         for i in range(len(self)))
+    self.cumulative = cumulative
+    return cumulative
+
+
+  def get_cumulative(self):
+    if self.cumulative is None:
+      return self.build()
+    return self.cumulative
+
+
+  def get_index(self, minute):
+    """
+    Returns the index of the first row that ends after <minute> (the row
+    going on at that minute), or len(self) if the schedule ends before it.
+    """
+    cumulative = self.get_cumulative()
+    if self.monotonic:
+      return bisect.bisect_right(cumulative, minute, 1) - 1
+    for index in range(len(self)):
+      if cumulative[index + 1] > minute:
+        return index
+    return len(self)
+
+
+  def get_index_starting_at(self, minute):
+    """
+    Returns the index of the first row that starts at or after <minute>, or
+    None if there is none.
+    """
+    cumulative = self.get_cumulative()
+    if self.monotonic:
+      index = bisect.bisect_left(cumulative, minute, 0, len(self))
+      if index < len(self):
+        return index
+      return None
+    for index in range(len(self)):
+      if cumulative[index] >= minute:
+        return index
+    return None
+
+
+  def get_start_min(self, index):
+    """
+    Returns the minute of the day at which the row at <index> starts.
+    """
+    return self.get_cumulative()[index]
+
+
+  def get_total_min(self):
+    return self.get_cumulative()[-1]
+
+
+  # Every list method that edits the list drops the cumulative durations.
+  # (Editing a row in place, e.g., schedule[0][1] = 30, is not seen; rows
+  # are replaced instead.)
+  def __setitem__(self, key, value):
+    super().__setitem__(key, value)
+    self.invalidate()
+
+
+  def __delitem__(self, key):
+    super().__delitem__(key)
+    self.invalidate()
+
+
+  def __iadd__(self, rows):
+    result = super().__iadd__(rows)
+    self.invalidate()
+    return result
+
+
+  def __imul__(self, n):
+    result = super().__imul__(n)
+    self.invalidate()
+    return result
+
+
+  def append(self, row):
+    super().append(row)
+    self.invalidate()
+
+
+  def extend(self, rows):
+    super().extend(rows)
+    self.invalidate()
+
+
+  def insert(self, index, row):
+    super().insert(index, row)
+    self.invalidate()
+
+
+  def pop(self, index=-1):
+    row = super().pop(index)
+    self.invalidate()
+    return row
+
+
+  def remove(self, row):
+    super().remove(row)
+    self.invalidate()
+
+
+  def clear(self):
+    super().clear()
+    self.invalidate()
+
+
+  def sort(self, *args, **kwargs):
+    super().sort(*args, **kwargs)
+    self.invalidate()
+
+
+  def reverse(self):
+    super().reverse()
+    self.invalidate()
@@ -5,11 +5,14 @@ File: scratch.py
 Description: Defines the short-term memory module for generative agents.
 """
 import datetime
+import hashlib
 import json
+import os
 import sys
 sys.path.append('../../')
 
 from global_methods import *
+from persona.memory_structures.schedule_list import *
 
 class Scratch: 
   def __init__(self, f_saved): 
@@ -101,6 +104,8 @@ class Scratch:
     # e.g., [['sleeping', 360], 
     #        ['wakes up and starts her morning routine', 120],
     #        ['working on her painting', 240], ... ['going to bed', 60]]
+    # Both are kept as <ScheduleList>s (see the properties below), so that
+    # the index lookups below do not walk the whole schedule. 
     self.f_daily_schedule_hourly_org = []
     
     # CURR ACTION 
@@ -158,6 +163,23 @@ class Scratch:
     # e.g., [(50, 10), (49, 10), (48, 10), ...]
     self.planned_path = []
 
+    # <location_memo> remembers where the persona decided to carry out an 
+    # action, so that recurring actions do not need the location prompts 
+    # again. It holds the s_mem version it is valid for, and the entries: 
+    # e.g., {"version": 412, 
+    #        "entries": {"the Ville:Hobbs Cafe|eating breakfast": 
+    #                      ["Lin family's house", "kitchen", "refrigerator"]}}
+    self.location_memo = dict()
+
+    # <plan_templates> holds the task decompositions the persona already 
+    # made, so that a block it plans again (e.g., "sleeping" or "morning 
+    # routine" on the next day) is not decomposed again. The key is 
+    # "<identity hash>|<duration>|<task>" (see get_identity_hash). 
+    # e.g., {"3f2a9c01|60|waking up and starting her morning routine": 
+    #          [["waking up and starting her morning routine (going to the 
+    #            bathroom)", 5], ...]}
+    self.plan_templates = dict()
+
     if check_if_file_exists(f_saved): 
       # If we have a bootstrap file, load that here. 
       scratch_load = json.load(open(f_saved))
@@ -232,6 +254,8 @@ class Scratch:
 
       self.act_path_set = scratch_load["act_path_set"]
       self.planned_path = scratch_load["planned_path"]
+      self.location_memo = scratch_load.get("location_memo", dict())
+      self.plan_templates = scratch_load.get("plan_templates", dict())
 
 
   def save(self, out_json):
@@ -305,9 +329,34 @@ class Scratch:
 
     scratch["act_path_set"] = self.act_path_set
     scratch["planned_path"] = self.planned_path
+    scratch["location_memo"] = self.location_memo
+    scratch["plan_templates"] = self.plan_templates
 
-    with open(out_json, "w") as outfile:
+    # The scratch is saved after every step (see ReverieServer.checkpoint),
+    # so it is written under a temporary name and then moved into place. 
+    with open(out_json + ".tmp", "w") as outfile:
       json.dump(scratch, outfile, indent=2) 
+    os.replace(out_json + ".tmp", out_json)
+
+
+  @property
+  def f_daily_schedule(self): 
+    return self._f_daily_schedule
+
+
+  @f_daily_schedule.setter
+  def f_daily_schedule(self, rows): 
+    self._f_daily_schedule = ScheduleList(rows)
+
+
+  @property
+  def f_daily_schedule_hourly_org(self): 
+    return self._f_daily_schedule_hourly_org
+
+
+  @f_daily_schedule_hourly_org.setter
+  def f_daily_schedule_hourly_org(self, rows): 
+    self._f_daily_schedule_hourly_org = ScheduleList(rows)
 
 
   def get_f_daily_schedule_index(self, advance=0):
@@ -317,9 +366,9 @@ class Scratch:
     Recall that self.f_daily_schedule stores the decomposed action sequences 
     up until now, and the hourly sequences of the future action for the rest
     of today. Given that self.f_daily_schedule is a list of list where the 
-    inner list is composed of [task, duration], we continue to add up the 
-    duration until we reach "if elapsed > today_min_elapsed" condition. The
-    index where we stop is the index we will return. 
+    inner list is composed of [task, duration], we look for the first task
+    whose cumulative duration is over the minutes elapsed today (a bisect 
+    over the cumulative durations kept by the ScheduleList). 
 
     INPUT
       advance: Integer value of the number minutes we want to look into the 
@@ -333,23 +382,8 @@ class Scratch:
     today_min_elapsed += self.curr_time.minute
     today_min_elapsed += advance
 
-    x = 0
-    for task, duration in self.f_daily_schedule: 
-      x += duration
-    x = 0
-    for task, duration in self.f_daily_schedule_hourly_org: 
-      x += duration
-
     # We then calculate the current index based on that. 
-    curr_index = 0
-    elapsed = 0
-    for task, duration in self.f_daily_schedule: 
-      elapsed += duration
-      if elapsed > today_min_elapsed: 
-        return curr_index
-      curr_index += 1
-
-    return curr_index
+    return self.f_daily_schedule.get_index(today_min_elapsed)
 
 
   def get_f_daily_schedule_hourly_org_index(self, advance=0):
@@ -369,14 +403,7 @@ class Scratch:
     today_min_elapsed += self.curr_time.minute
     today_min_elapsed += advance
     # We then calculate the current index based on that. 
-    curr_index = 0
-    elapsed = 0
-    for task, duration in self.f_daily_schedule_hourly_org: 
-      elapsed += duration
-      if elapsed > today_min_elapsed: 
-        return curr_index
-      curr_index += 1
-    return curr_index
+    return self.f_daily_schedule_hourly_org.get_index(today_min_elapsed)
 
 
   def get_str_iss(self): 
@@ -414,6 +441,22 @@ class Scratch:
     return commonset
 
 
+  def get_identity_hash(self): 
+    """
+    A short hash of the parts of the identity stable set that do not change 
+    from day to day (name, age, traits and lifestyle). Unlike get_str_iss, 
+    it leaves out <currently>, <daily_plan_req> and the date. 
+
+    OUTPUT
+      a hex string. 
+    EXAMPLE STR OUTPUT
+      "3f2a9c01"
+    """
+    identity = "\n".join(str(i) for i in [self.name, self.age, self.innate, 
+                                          self.learned, self.lifestyle])
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()[:8]
+
+
   def get_str_name(self): 
     return self.name
 
@@ -530,13 +573,14 @@ class Scratch:
     return self.act_start_time.strftime("%H:%M %p")
 
 
-  def act_check_finished(self): 
+  def act_check_finished(self, curr_time=None): 
     """
     Checks whether the self.Action instance has finished.  
 
     INPUT
-      curr_datetime: Current time. If current time is later than the action's
-                     start time + its duration, then the action has finished. 
+      curr_time: Current time (self.curr_time if None). If current time is 
+                 later than the action's start time + its duration, then the
+                 action has finished. 
     OUTPUT 
       Boolean [True]: Action has finished.
       Boolean [False]: Action has not finished and is still ongoing.
@@ -553,7 +597,9 @@ class Scratch:
         x = (x + datetime.timedelta(minutes=1))
       end_time = (x + datetime.timedelta(minutes=self.act_duration))
 
-    if end_time.strftime("%H:%M:%S") == self.curr_time.strftime("%H:%M:%S"): 
+    if curr_time is None: 
+      curr_time = self.curr_time
+    if end_time.strftime("%H:%M:%S") == curr_time.strftime("%H:%M:%S"): 
       return True
     return False
 
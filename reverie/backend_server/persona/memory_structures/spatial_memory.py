@@ -18,6 +18,50 @@ class MemoryTree:
     if check_if_file_exists(f_saved): 
       self.tree = json.load(open(f_saved))
 
+    # <version> is the number of places (worlds, sectors, arenas and game 
+    # objects) in the tree. The tree only ever grows, so the version changes
+    # exactly when the persona learns about a new place. Anything derived 
+    # from the tree (e.g., the location memo in scratch) is keyed by it. 
+    self.version = self.count_places()
+
+
+  def count_places(self): 
+    def _count_places(tree): 
+      if type(tree) == type(list()): 
+        return len(tree)
+      return len(tree) + sum(_count_places(val) for val in tree.values())
+    return _count_places(self.tree)
+
+
+  def add_location(self, world, sector, arena, game_object): 
+    """
+    Adds the levels of the address that are not in the tree yet. Empty 
+    levels are skipped. 
+
+    INPUT
+      world, sector, arena, game_object: The parts of a tile's address, as 
+        returned by maze.access_tile (e.g., "the Ville", "Hobbs Cafe", 
+        "cafe", "cafe customer seating"). 
+    OUTPUT 
+      None
+    """
+    if world: 
+      if world not in self.tree: 
+        self.tree[world] = {}
+        self.version += 1
+    if sector: 
+      if sector not in self.tree[world]: 
+        self.tree[world][sector] = {}
+        self.version += 1
+    if arena: 
+      if arena not in self.tree[world][sector]: 
+        self.tree[world][sector][arena] = []
+        self.version += 1
+    if game_object: 
+      if game_object not in self.tree[world][sector][arena]: 
+        self.tree[world][sector][arena] += [game_object]
+        self.version += 1
+
 
   def print_tree(self): 
     def _print_tree(tree, depth):
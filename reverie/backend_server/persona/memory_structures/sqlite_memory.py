@@ -0,0 +1,394 @@
+"""
+File: sqlite_memory.py
+Description: An associative memory backend that keeps the memory stream in a
+SQLite database (associative_memory.db in the memory folder) instead of in
+nodes.json. Nodes are written to the database as they are created, and are
+only turned into <ConceptNode>s when they are first used, so a persona with a
+very large memory does not need to load it all at startup.
+
+The database can also be queried directly by offline tools:
+  nodes (node_count INTEGER PRIMARY KEY, node_id, type_count, type, depth,
+         created, expiration, last_accessed, subject, predicate, object,
+         description, embedding_key, poignancy, keywords, filling)
+  keywords (keyword, type, node_count)
+  embeddings (key PRIMARY KEY, vector)  -- float32 bytes
+  kw_strength (type, keyword, strength)
+Datetimes are stored as '%Y-%m-%d %H:%M:%S' strings, and keywords and filling
+as json.
+"""
+import sys
+sys.path.append('../../')
+
+import json
+import datetime
+import os
+import sqlite3
+from collections.abc import Mapping
+
+import numpy
+
+from global_methods import *
+from persona.memory_structures.associative_memory import *
+
+
+class SQLiteNodeStream(MemoryStream):
+  """
+  A newest-first <MemoryStream> of the nodes of one type (and, optionally,
+  one keyword) that reads its nodes from the database.
+  """
+  def __init__(self, memory, node_type, keyword=None):
+    self.memory = memory
+    self.node_type = node_type
+    self.keyword = keyword
+    # The length of a full type stream is counted once and then kept up to
+    # date by prepend().
+    self.count = None
+
+
+  def _query(self, limit=-1, offset=0, newest_first=True):
+    order = "DESC" if newest_first else "ASC"
+    if self.keyword is None:
+      rows = self.memory.conn.execute(
+        "SELECT node_count FROM nodes WHERE type = ? "
+        f"ORDER BY node_count {order} LIMIT ? OFFSET ?",
+        (self.node_type, limit, offset))
+    else:
+      rows = self.memory.conn.execute(
+        "SELECT node_count FROM keywords WHERE keyword = ? AND type = ? "
+        f"ORDER BY node_count {order} LIMIT ? OFFSET ?",
+        (self.keyword, self.node_type, limit, offset))
+    return [self.memory.get_node(row[0]) for row in rows.fetchall()]
+
+
+  def prepend(self, node):
+    # The node itself is written to the database by the memory (see
+    # SQLiteAssociativeMemory.add_node_embedding).
+    if self.count is not None:
+      self.count += 1
+
+
+  def __len__(self):
+    if self.keyword is not None:
+      return self.memory.conn.execute(
+        "SELECT COUNT(*) FROM keywords WHERE keyword = ? AND type = ?",
+        (self.keyword, self.node_type)).fetchone()[0]
+    if self.count is None:
+      self.count = self.memory.conn.execute(
+        "SELECT COUNT(*) FROM nodes WHERE type = ?",
+        (self.node_type,)).fetchone()[0]
+    return self.count
+
+
+  def __iter__(self):
+    return iter(self._query())
+
+
+  def __reversed__(self):
+    return iter(self._query(newest_first=False))
+
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      if index.step in (None, 1) and (index.start or 0) >= 0 \
+         and (index.stop is None or index.stop >= 0):
+        start = index.start or 0
+        if index.stop is None:
+          return self._query(offset=start)
+        if index.stop <= start:
+          return []
+        return self._query(limit=index.stop - start, offset=start)
+      return list(self)[index]
+
+    if index < 0:
+      nodes = self._query(limit=1, offset=-index - 1, newest_first=False)
+    else:
+      nodes = self._query(limit=1, offset=index)
+    if not nodes:
+      raise IndexError("MemoryStream index out of range")
+    return nodes[0]
+
+
+  def __repr__(self):
+    return (f"SQLiteNodeStream({self.node_type!r}, {self.keyword!r}, "
+            f"{len(self)} nodes)")
+
+
+class SQLiteKeywordIndex:
+  """
+  The kw_to_event/kw_to_thought/kw_to_chat index of the SQLite backend. Maps
+  a (lowercase) keyword to the newest-first stream of nodes that have it.
+  """
+  def __init__(self, memory, node_type):
+    self.memory = memory
+    self.node_type = node_type
+
+
+  def __contains__(self, keyword):
+    return self.memory.conn.execute(
+      "SELECT 1 FROM keywords WHERE keyword = ? AND type = ? LIMIT 1",
+      (keyword, self.node_type)).fetchone() is not None
+
+
+  def __getitem__(self, keyword):
+    if keyword not in self:
+      raise KeyError(keyword)
+    return SQLiteNodeStream(self.memory, self.node_type, keyword)
+
+
+  def __setitem__(self, keyword, stream):
+    # Keyword rows are written along with their node.
+    pass
+
+
+  def keys(self):
+    return [row[0] for row in self.memory.conn.execute(
+      "SELECT DISTINCT keyword FROM keywords WHERE type = ?",
+      (self.node_type,))]
+
+
+class SQLiteNodeMap(Mapping):
+  """
+  The id_to_node dictionary of the SQLite backend (node_id -> ConceptNode).
+  """
+  def __init__(self, memory):
+    self.memory = memory
+
+
+  def __getitem__(self, node_id):
+    try:
+      node_count = int(node_id.split("_")[-1])
+    except (AttributeError, ValueError):
+      raise KeyError(node_id)
+    if not 1 <= node_count <= self.memory.node_total:
+      raise KeyError(node_id)
+    return self.memory.get_node(node_count)
+
+
+  def __setitem__(self, node_id, node):
+    self.memory.node_cache[node.node_count] = node
+    self.memory.node_total = max(self.memory.node_total, node.node_count)
+
+
+  def __len__(self):
+    return self.memory.node_total
+
+
+  def __iter__(self):
+    for count in range(1, self.memory.node_total + 1):
+      yield f"node_{count}"
+
+
+class SQLiteAssociativeMemory(AssociativeMemory):
+  def __init__(self, f_saved, resume_time=None):
+    self.f_saved = f_saved
+    db_file = f"{f_saved}/associative_memory.db"
+    migrate = not check_if_file_exists(db_file)
+
+    self.conn = sqlite3.connect(db_file, check_same_thread=False)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("PRAGMA synchronous=NORMAL")
+    self.create_tables()
+
+    # <node_cache> holds the nodes that have been loaded so far, so that a
+    # node is always the same <ConceptNode> object.
+    self.node_cache = dict()
+    self.node_total = self.conn.execute(
+      "SELECT COUNT(*) FROM nodes").fetchone()[0]
+    self.id_to_node = SQLiteNodeMap(self)
+
+    self.seq_event = SQLiteNodeStream(self, "event")
+    self.seq_thought = SQLiteNodeStream(self, "thought")
+    self.seq_chat = SQLiteNodeStream(self, "chat")
+
+    self.kw_to_event = SQLiteKeywordIndex(self, "event")
+    self.kw_to_thought = SQLiteKeywordIndex(self, "thought")
+    self.kw_to_chat = SQLiteKeywordIndex(self, "chat")
+
+    self.kw_strength_event = dict()
+    self.kw_strength_thought = dict()
+    for node_type, keyword, strength in self.conn.execute(
+        "SELECT type, keyword, strength FROM kw_strength"):
+      if node_type == "event":
+        self.kw_strength_event[keyword] = strength
+      else:
+        self.kw_strength_thought[keyword] = strength
+
+    self.embeddings = EmbeddingStore(get_embeddings)
+    for key, vector in self.conn.execute("SELECT key, vector FROM embeddings"):
+      self.embeddings[key] = numpy.frombuffer(vector, dtype=numpy.float32)
+    self.ann_index = None
+    self.recency_index = None
+
+    # The json journal is not used by this backend.
+    self.journal_file = None
+    self.journal_records = 0
+
+    if migrate:
+      self.migrate_from_json(f_saved, resume_time)
+
+
+  def create_tables(self):
+    with self.conn:
+      self.conn.execute("CREATE TABLE IF NOT EXISTS nodes ("
+                        "node_count INTEGER PRIMARY KEY, node_id TEXT, "
+                        "type_count INTEGER, type TEXT, depth INTEGER, "
+                        "created TEXT, expiration TEXT, last_accessed TEXT, "
+                        "subject TEXT, predicate TEXT, object TEXT, "
+                        "description TEXT, embedding_key TEXT, "
+                        "poignancy REAL, keywords TEXT, filling TEXT)")
+      self.conn.execute("CREATE INDEX IF NOT EXISTS nodes_type "
+                        "ON nodes (type)")
+      self.conn.execute("CREATE INDEX IF NOT EXISTS nodes_type_created "
+                        "ON nodes (type, created)")
+      self.conn.execute("CREATE INDEX IF NOT EXISTS nodes_last_accessed "
+                        "ON nodes (last_accessed)")
+      self.conn.execute("CREATE TABLE IF NOT EXISTS keywords ("
+                        "keyword TEXT, type TEXT, node_count INTEGER)")
+      self.conn.execute("CREATE INDEX IF NOT EXISTS keywords_keyword "
+                        "ON keywords (keyword, type, node_count)")
+      self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings ("
+                        "key TEXT PRIMARY KEY, vector BLOB)")
+      self.conn.execute("CREATE TABLE IF NOT EXISTS kw_strength ("
+                        "type TEXT, keyword TEXT, strength INTEGER, "
+                        "PRIMARY KEY (type, keyword))")
+
+
+  def migrate_from_json(self, f_saved, resume_time=None):
+    """
+    Fills a new database from the json memory (snapshot and journal) in
+    <f_saved>, if there is one. The json files are left as they are.
+    """
+    if not check_if_file_exists(f"{f_saved}/nodes.json"):
+      return
+    json_memory = AssociativeMemory(f_saved, resume_time, read_only=True)
+    self.embeddings = json_memory.embeddings
+    with self.conn:
+      for count in range(1, len(json_memory.id_to_node) + 1):
+        node = json_memory.id_to_node[f"node_{count}"]
+        self.insert_node(node)
+      self.conn.executemany(
+        "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+        [(key, self.embeddings[key].tobytes()) for key in self.embeddings])
+      self.kw_strength_event = json_memory.kw_strength_event
+      self.kw_strength_thought = json_memory.kw_strength_thought
+      self.write_kw_strength("event", self.kw_strength_event.keys())
+      self.write_kw_strength("thought", self.kw_strength_thought.keys())
+    self.node_total = len(json_memory.id_to_node)
+    self.seq_event.count = None
+    self.seq_thought.count = None
+    self.seq_chat.count = None
+
+
+  def get_node(self, node_count):
+    """
+    Returns the <ConceptNode> of <node_count>, loading it from the database
+    if it was not used before.
+    """
+    if node_count in self.node_cache:
+      return self.node_cache[node_count]
+
+    row = self.conn.execute(
+      "SELECT node_id, node_count, type_count, type, depth, created, "
+      "expiration, last_accessed, subject, predicate, object, description, "
+      "embedding_key, poignancy, keywords, filling "
+      "FROM nodes WHERE node_count = ?", (node_count,)).fetchone()
+    if row is None:
+      raise KeyError(f"node_{node_count}")
+
+    (node_id, node_count, type_count, node_type, depth, created, expiration,
+     last_accessed, s, p, o, description, embedding_key, poignancy,
+     keywords, filling) = row
+    created = datetime.datetime.strptime(created, '%Y-%m-%d %H:%M:%S')
+    if expiration:
+      expiration = datetime.datetime.strptime(expiration, '%Y-%m-%d %H:%M:%S')
+    if poignancy == int(poignancy):
+      poignancy = int(poignancy)
+    node = ConceptNode(node_id, node_count, type_count, node_type, depth,
+                       created, expiration,
+                       s, p, o,
+                       description, embedding_key, poignancy,
+                       set(json.loads(keywords)), json.loads(filling))
+    if last_accessed:
+      node.last_accessed = datetime.datetime.strptime(last_accessed,
+                                                      '%Y-%m-%d %H:%M:%S')
+    self.node_cache[node_count] = node
+    return node
+
+
+  def insert_node(self, node):
+    r = self.node_to_dict(node)
+    self.conn.execute(
+      "INSERT OR REPLACE INTO nodes (node_count, node_id, type_count, type, "
+      "depth, created, expiration, last_accessed, subject, predicate, "
+      "object, description, embedding_key, poignancy, keywords, filling) "
+      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+      (node.node_count, node.node_id, r["type_count"], r["type"], r["depth"],
+       r["created"], r["expiration"],
+       node.last_accessed.strftime('%Y-%m-%d %H:%M:%S'),
+       r["subject"], r["predicate"], r["object"], r["description"],
+       r["embedding_key"], r["poignancy"], json.dumps(r["keywords"]),
+       json.dumps(r["filling"])))
+    self.conn.executemany(
+      "INSERT INTO keywords (keyword, type, node_count) VALUES (?, ?, ?)",
+      [(keyword, node.type, node.node_count)
+       for keyword in set(i.lower() for i in node.keywords)])
+
+
+  def write_kw_strength(self, node_type, keywords):
+    kw_strength = self.kw_strength_event
+    if node_type == "thought":
+      kw_strength = self.kw_strength_thought
+    self.conn.executemany(
+      "INSERT OR REPLACE INTO kw_strength (type, keyword, strength) "
+      "VALUES (?, ?, ?)",
+      [(node_type, keyword, kw_strength[keyword])
+       for keyword in keywords if keyword in kw_strength])
+
+
+  def add_node_embedding(self, node, embedding_pair):
+    """
+    Stores the embedding of a newly added <node>, and writes the node (with
+    its keywords, new embedding and keyword strengths) to the database.
+    """
+    new_key = embedding_pair[0] not in self.embeddings
+    old_dim = self.embeddings.get_matrix().shape[1]
+    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+
+    with self.conn:
+      self.insert_node(node)
+      if old_dim and old_dim != self.embeddings.get_matrix().shape[1]:
+        # The store embedded every key again with the new model (see
+        # EmbeddingStore._reencode), so the table is rewritten to match.
+        self.conn.execute("DELETE FROM embeddings")
+        self.conn.executemany(
+          "INSERT INTO embeddings (key, vector) VALUES (?, ?)",
+          [(key, self.embeddings[key].tobytes()) for key in self.embeddings])
+      elif new_key:
+        self.conn.execute(
+          "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+          (embedding_pair[0], self.embeddings[embedding_pair[0]].tobytes()))
+      if node.type in ("event", "thought"):
+        self.write_kw_strength(node.type, [i.lower() for i in node.keywords])
+
+
+  def save(self, out_json, compact=False):
+    """
+    Nodes are already in the database when they are created, so saving only
+    writes back the last_accessed times of the nodes in use. Saving to
+    another folder copies the database there. With <compact>, a json
+    snapshot (nodes.json, kw_strength.json and the embeddings) is written as
+    well, for tools that read those files.
+    """
+    with self.conn:
+      self.conn.executemany(
+        "UPDATE nodes SET last_accessed = ? WHERE node_count = ?",
+        [(node.last_accessed.strftime('%Y-%m-%d %H:%M:%S'), count)
+         for count, node in self.node_cache.items()])
+
+    if os.path.realpath(out_json) != os.path.realpath(self.f_saved):
+      out_conn = sqlite3.connect(f"{out_json}/associative_memory.db")
+      self.conn.backup(out_conn)
+      out_conn.close()
+
+    if compact:
+      AssociativeMemory.save(self, out_json, compact)
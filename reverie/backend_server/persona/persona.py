@@ -18,6 +18,7 @@ from global_methods import *
 
 from persona.memory_structures.spatial_memory import *
 from persona.memory_structures.associative_memory import *
+from persona.memory_structures.sqlite_memory import *
 from persona.memory_structures.scratch import *
 
 from persona.cognitive_modules.perceive import *
@@ -27,8 +28,14 @@ from persona.cognitive_modules.reflect import *
 from persona.cognitive_modules.execute import *
 from persona.cognitive_modules.converse import *
 
+# <associative_memory_backend> picks where the associative memory is kept: 
+# "json" for nodes.json plus its journal, or "sqlite" for 
+# associative_memory.db (see sqlite_memory.py). A json memory is migrated 
+# into the database the first time it is opened with "sqlite". 
+associative_memory_backend = "json"
+
 class Persona: 
-  def __init__(self, name, folder_mem_saved=False):
+  def __init__(self, name, folder_mem_saved=False, resume_time=None):
     # PERSONA BASE STATE 
     # <name> is the full name of the persona. This is a unique identifier for
     # the persona within Reverie. 
@@ -40,20 +47,34 @@ class Persona:
     # <s_mem> is the persona's spatial memory. 
     f_s_mem_saved = f"{folder_mem_saved}/bootstrap_memory/spatial_memory.json"
     self.s_mem = MemoryTree(f_s_mem_saved)
-    # <s_mem> is the persona's associative memory. 
+    # <s_mem> is the persona's associative memory. <resume_time> is the 
+    # time the simulation resumes at; the nodes journaled at or after it 
+    # belong to steps that will be run again (see AssociativeMemory). 
     f_a_mem_saved = f"{folder_mem_saved}/bootstrap_memory/associative_memory"
-    self.a_mem = AssociativeMemory(f_a_mem_saved)
+    if associative_memory_backend == "sqlite": 
+      self.a_mem = SQLiteAssociativeMemory(f_a_mem_saved, resume_time)
+    else: 
+      self.a_mem = AssociativeMemory(f_a_mem_saved, resume_time)
     # <scratch> is the persona's scratch (short term memory) space. 
     scratch_saved = f"{folder_mem_saved}/bootstrap_memory/scratch.json"
     self.scratch = Scratch(scratch_saved)
 
+    # <rng> is the persona's own random number generator for the choices made
+    # in its cognitive sequence. Keeping it per persona means that personas 
+    # stepped in parallel do not interleave draws from a shared generator. 
+    # It is seeded from the global generator, so seeding <random> still makes
+    # a whole simulation reproducible. 
+    self.rng = random.Random(random.getrandbits(64))
+
 
-  def save(self, save_folder): 
+  def save(self, save_folder, compact=False): 
     """
     Save persona's current state (i.e., memory). 
 
     INPUT: 
       save_folder: The folder where we wil be saving our persona's state. 
+      compact: If True, the associative memory writes a full snapshot and 
+               empties its journal (see AssociativeMemory.save). 
     OUTPUT: 
       None
     """
@@ -69,7 +90,7 @@ class Persona:
     # [event.type, event.created, event.expiration, s, p, o]
     # e.g., event,2022-10-23 00:00:00,,Isabella Rodriguez,is,idle
     f_a_mem = f"{save_folder}/associative_memory"
-    self.a_mem.save(f_a_mem)
+    self.a_mem.save(f_a_mem, compact)
 
     # Scratch contains non-permanent data associated with the persona. When 
     # it is saved, it takes a json form. When we load it, we move the values
@@ -78,7 +99,7 @@ class Persona:
     self.scratch.save(f_scratch)
 
 
-  def perceive(self, maze):
+  def perceive(self, maze, nearby_tiles=None):
     """
     This function takes the current maze, and returns events that are 
     happening around the persona. Importantly, perceive is guided by 
@@ -99,12 +120,14 @@ class Persona:
 
     INPUT: 
       maze: Current <Maze> instance of the world. 
+      nearby_tiles: the tiles within the persona's vision radius, if the 
+                    caller already has them. 
     OUTPUT: 
       a list of <ConceptNode> that are perceived and new. 
         See associative_memory.py -- but to get you a sense of what it 
         receives as its input: "s, p, o, desc, persona.scratch.curr_time"
     """
-    return perceive(self, maze)
+    return perceive(self, maze, nearby_tiles)
 
 
   def retrieve(self, perceived):
@@ -182,7 +205,7 @@ class Persona:
     reflect(self)
 
 
-  def move(self, maze, personas, curr_tile, curr_time):
+  def move(self, maze, personas, curr_tile, curr_time, nearby_tiles=None):
     """
     This is the main cognitive function where our main sequence is called. 
 
@@ -193,6 +216,8 @@ class Persona:
       curr_tile: A tuple that designates the persona's current tile location 
                  in (row, col) form. e.g., (58, 39)
       curr_time: datetime instance that indicates the game's current time. 
+      nearby_tiles: the tiles within the persona's vision radius around 
+                    <curr_tile>, if the caller already has them. 
     OUTPUT: 
       execution: A triple set that contains the following components: 
         <next_tile> is a x,y coordinate. e.g., (58, 9)
@@ -217,7 +242,7 @@ class Persona:
     self.scratch.curr_time = curr_time
 
     # Main cognitive sequence begins here. 
-    perceived = self.perceive(maze)
+    perceived = self.perceive(maze, nearby_tiles)
     retrieved = self.retrieve(perceived)
     plan = self.plan(maze, personas, new_day, retrieved)
     self.reflect()
@@ -231,6 +256,62 @@ class Persona:
     return self.execute(maze, personas, plan)
 
 
+  def can_fast_forward(self, maze, curr_tile, curr_time, nearby_tiles): 
+    """
+    Checks whether the cognitive sequence of move() would leave the persona
+    as it is in this step, so that fast_forward() can be called instead. 
+    That is the case when it is not a new day, the current action is still 
+    going on (it is not a chat, its path is set, and it is not heading to 
+    another persona), no reflection is due, and the persona does not 
+    perceive any new event at <curr_tile>. e.g., the persona is asleep, or 
+    walking along its planned path with nothing new in sight. 
+
+    INPUT: 
+      maze, curr_tile, curr_time: see move(). 
+      nearby_tiles: the tiles within the persona's vision radius around 
+                    <curr_tile> (see Maze.get_nearby_tiles). 
+    OUTPUT: 
+      a boolean. 
+    """
+    if (not self.scratch.curr_time 
+        or (self.scratch.curr_time.strftime('%A %B %d')
+            != curr_time.strftime('%A %B %d'))): 
+      return False
+    if self.scratch.act_check_finished(curr_time): 
+      return False
+    if (self.scratch.chatting_with 
+        or self.scratch.chatting_end_time 
+        or not self.scratch.act_path_set 
+        or "<persona>" in self.scratch.act_address): 
+      return False
+    if reflection_trigger(self): 
+      return False
+
+    # move() and fast_forward() both start by setting the current tile. 
+    self.scratch.curr_tile = curr_tile
+    return not has_new_events(self, maze, nearby_tiles)
+
+
+  def fast_forward(self, maze, personas, curr_tile, curr_time, nearby_tiles): 
+    """
+    Advances the persona by one step without its cognitive sequence. Only 
+    the state that move() would change when can_fast_forward() holds is 
+    updated: the current tile and time, the spatial memory, the chat buffer,
+    and the position along the planned path. 
+
+    INPUT: 
+      maze, personas, curr_tile, curr_time: see move(). 
+      nearby_tiles: see can_fast_forward(). 
+    OUTPUT: 
+      execution: see move(). 
+    """
+    self.scratch.curr_tile = curr_tile
+    self.scratch.curr_time = curr_time
+    perceive_space(self, maze, nearby_tiles)
+    advance_chatting_with_buffer(self)
+    return self.execute(maze, personas, self.scratch.act_address)
+
+
   def open_convo_session(self, convo_mode): 
     open_convo_session(self, convo_mode)
     
@@ -0,0 +1,140 @@
+"""
+File: gpt_cache.py
+Description: A small on-disk key-value cache with LRU eviction. It is used to
+remember LLM completions so that identical prompts do not need another round
+trip to the API server.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import sys
+sys.path.append('../../')
+
+from global_methods import *
+
+
+def make_cache_key(*parts):
+  """
+  Turns the given parts (e.g., model name, prompt, gpt_parameter) into a
+  content-addressed key. The parts are serialized with sorted keys so that
+  two dictionaries with the same content always hash to the same key.
+
+  INPUT:
+    parts: any JSON serializable values.
+  OUTPUT:
+    a hex sha256 digest string.
+  """
+  payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+  return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskLRUCache:
+  def __init__(self, db_file, max_entries=50000):
+    # <db_file> is the sqlite file that backs the cache. It is only opened on
+    # first use, so importing this module has no side effects on disk.
+    self.db_file = db_file
+    # <max_entries> bounds the number of rows. Once we go over, the least
+    # recently used rows are evicted.
+    self.max_entries = max_entries
+
+    # Counters for the current process.
+    self.hits = 0
+    self.misses = 0
+    self.writes = 0
+    self.evictions = 0
+
+    self.conn = None
+    self.lock = threading.Lock()
+
+
+  def _connect(self):
+    if self.conn:
+      return self.conn
+    create_folder_if_not_there(self.db_file)
+    self.conn = sqlite3.connect(self.db_file,
+                                timeout=30,
+                                check_same_thread=False,
+                                isolation_level=None)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("PRAGMA synchronous=NORMAL")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS cache ("
+                      "key TEXT PRIMARY KEY, "
+                      "value BLOB NOT NULL, "
+                      "last_used REAL NOT NULL)")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used "
+                      "ON cache (last_used)")
+    return self.conn
+
+
+  def get(self, key):
+    """
+    Returns the cached value for <key> (bytes), or None if it is not in the
+    cache. A hit refreshes the entry's position in the LRU order.
+    """
+    with self.lock:
+      conn = self._connect()
+      row = conn.execute("SELECT value FROM cache WHERE key = ?",
+                         (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      conn.execute("UPDATE cache SET last_used = ? WHERE key = ?",
+                   (time.time(), key))
+      self.hits += 1
+      return bytes(row[0])
+
+
+  def put(self, key, value):
+    """
+    Stores <value> (bytes) under <key>, evicting the least recently used
+    entries if the cache grew beyond <max_entries>.
+    """
+    with self.lock:
+      conn = self._connect()
+      conn.execute("INSERT OR REPLACE INTO cache (key, value, last_used) "
+                   "VALUES (?, ?, ?)", (key, sqlite3.Binary(value),
+                                        time.time()))
+      self.writes += 1
+      # Counting rows is cheap, but there is no need to do it on every write.
+      if self.writes % 100 == 1:
+        self._evict(conn)
+
+
+  def _evict(self, conn):
+    n_rows = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+    overflow = n_rows - self.max_entries
+    if overflow > 0:
+      conn.execute("DELETE FROM cache WHERE key IN "
+                   "(SELECT key FROM cache ORDER BY last_used LIMIT ?)",
+                   (overflow,))
+      self.evictions += overflow
+
+
+  def get_str(self, key):
+    value = self.get(key)
+    if value is None:
+      return None
+    return value.decode("utf-8")
+
+
+  def put_str(self, key, value):
+    self.put(key, value.encode("utf-8"))
+
+
+  def stats(self):
+    """
+    Returns a dictionary summary of the cache usage in this process.
+    e.g., {'hits': 120, 'misses': 40, 'hit_rate': 0.75, 'writes': 40,
+           'evictions': 0}
+    """
+    lookups = self.hits + self.misses
+    hit_rate = 0
+    if lookups:
+      hit_rate = self.hits / lookups
+    return {"hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(hit_rate, 4),
+            "writes": self.writes,
+            "evictions": self.evictions}
@@ -4,58 +4,167 @@ Modified for DeepSeek compatibility with robust JSON parsing and error recovery.
 """
 import json
 import random
-import openai
 import time 
 import re 
+import asyncio
+import threading
+import concurrent.futures
 
 from utils import *
+from persona.prompt_template.gpt_cache import *
+from persona.prompt_template.prompt_registry import *
 
-# 强制指向 DeepSeek 服务器
-openai.api_base = "https://api.deepseek.com" 
-openai.api_key = openai_api_key
+# The openai client and the sentence embedding model are slow to import, so
+# they are only loaded on first use (see get_openai and get_embed_model). 
+# Tools that only need the prompt functions, or whose embeddings are all in 
+# the cache, never load them. 
+_openai = None
+_embed_model_lock = threading.Lock()
+
+def get_openai(): 
+    """
+    Imports and configures the openai module on first use. 
+    """
+    global _openai
+    if _openai is None: 
+        import openai
+        # 强制指向 DeepSeek 服务器
+        openai.api_base = "https://api.deepseek.com" 
+        openai.api_key = openai_api_key
+        _openai = openai
+    return _openai
+
+# Completion cache. Identical (model, prompt, gpt_parameter) requests are
+# answered from disk instead of going to the API server again. Callers whose
+# prompts should stay stochastic pass cache=False to the safe_generate
+# functions. 
+llm_model = "deepseek-chat"
+llm_cache_enabled = True
+llm_cache_max_entries = 50000
+# Sentinel strings returned by the request functions when the API call fails.
+# These are never written to the cache. 
+llm_error_responses = ("TOKEN LIMIT EXCEEDED", "ChatGPT ERROR", "error")
+completion_cache = DiskLRUCache(f"{fs_temp_storage}/llm_completion_cache.db",
+                                llm_cache_max_entries)
 
 def temp_sleep(seconds=0.1):
     time.sleep(seconds)
 
-def ChatGPT_single_request(prompt): 
-    temp_sleep()
+# ============================================================================
+# ########################[SECTION 0: ASYNC LLM CLIENT] ######################
+# ============================================================================
+
+# All API requests run as coroutines on one background event loop. The
+# semaphore bounds how many requests are in flight at once (this replaces the
+# old temp_sleep() throttle), so many personas can wait on the API server at
+# the same time without flooding it. The *_async coroutines below must be
+# awaited on that loop; other threads go through run_llm_coroutine(). 
+llm_max_concurrency = 16
+
+_llm_loop = None
+_llm_semaphore = None
+_llm_loop_lock = threading.Lock()
+
+async def _create_llm_semaphore(): 
+    # The semaphore has to be created on the loop that will use it. 
+    return asyncio.Semaphore(llm_max_concurrency)
+
+def get_llm_loop(): 
+    """
+    Returns the background event loop that all LLM requests are run on. The
+    loop is started in a daemon thread on first use, so that synchronous code
+    running in any thread can submit requests to it. 
+    """
+    global _llm_loop, _llm_semaphore
+    with _llm_loop_lock: 
+        if _llm_loop is None: 
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, 
+                             name="llm-client", 
+                             daemon=True).start()
+            _llm_semaphore = asyncio.run_coroutine_threadsafe(
+                _create_llm_semaphore(), loop).result()
+            _llm_loop = loop
+    return _llm_loop
+
+def run_llm_coroutine(coro): 
+    """
+    Runs <coro> on the LLM event loop and blocks the calling thread until it
+    finishes. This is how the synchronous request functions below reach the
+    async client. It must not be called from the LLM loop itself. 
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_llm_loop()).result()
+
+async def _chat_completion_async(prompt, **kwargs): 
+    get_llm_loop()
+    async with _llm_semaphore: 
+        return await get_openai().ChatCompletion.acreate(
+            model=llm_model, 
+            messages=[{"role": "user", "content": prompt}], 
+            **kwargs)
+
+async def ChatGPT_single_request_async(prompt): 
     try:
-        completion = openai.ChatCompletion.create(
-            model="deepseek-chat", 
-            messages=[{"role": "user", "content": prompt}]
-        )
+        completion = await _chat_completion_async(prompt)
         return completion["choices"][0]["message"]["content"]
     except Exception as e:
         print(f"Single Request Error: {e}")
         return "error"
 
-# ============================================================================
-# #####################[SECTION 1: CHATGPT-3 STRUCTURE] ######################
-# ============================================================================
-
-def GPT4_request(prompt): 
-    temp_sleep()
+async def ChatGPT_request_async(prompt): 
     try: 
-        completion = openai.ChatCompletion.create(
-        model="deepseek-chat", 
-        messages=[{"role": "user", "content": prompt}]
-        )
+        completion = await _chat_completion_async(prompt)
         return completion["choices"][0]["message"]["content"]
     except Exception as e: 
         print (f"ChatGPT ERROR: {e}")
         return "ChatGPT ERROR"
 
-def ChatGPT_request(prompt): 
-    temp_sleep()
+async def GPT4_request_async(prompt): 
+    return await ChatGPT_request_async(prompt)
+
+async def GPT_request_async(prompt, gpt_parameter): 
     try: 
-        completion = openai.ChatCompletion.create(
-        model="deepseek-chat", 
-        messages=[{"role": "user", "content": prompt}]
-        )
-        return completion["choices"][0]["message"]["content"]
+        response = await _chat_completion_async(
+                prompt,
+                temperature=gpt_parameter["temperature"],
+                max_tokens=gpt_parameter["max_tokens"],
+                top_p=gpt_parameter["top_p"],
+                frequency_penalty=gpt_parameter["frequency_penalty"],
+                presence_penalty=gpt_parameter["presence_penalty"],
+                stop=gpt_parameter["stop"],)
+        return response.choices[0].message.content
     except Exception as e: 
-        print (f"ChatGPT ERROR: {e}")
-        return "ChatGPT ERROR"
+        print (f"DeepSeek API 报错: {e}")
+        return "TOKEN LIMIT EXCEEDED"
+
+def ChatGPT_single_request(prompt): 
+    return run_llm_coroutine(ChatGPT_single_request_async(prompt))
+
+# ============================================================================
+# #####################[SECTION 1: CHATGPT-3 STRUCTURE] ######################
+# ============================================================================
+
+def GPT4_request(prompt): 
+    return run_llm_coroutine(GPT4_request_async(prompt))
+
+def ChatGPT_request(prompt): 
+    return run_llm_coroutine(ChatGPT_request_async(prompt))
+
+def extract_json_output(curr_gpt_response): 
+    """
+    Pulls the "output" field out of a json-formatted ChatGPT response. Raises
+    an exception if the response cannot be parsed. 
+    """
+    # --- 核心修复：自动补全缺失的右大括号 ---
+    if curr_gpt_response.count('{') > curr_gpt_response.count('}'):
+        curr_gpt_response += "}"
+
+    json_match = re.search(r'\{.*\}', curr_gpt_response, re.DOTALL)
+    if json_match:
+        curr_gpt_response = json_match.group()
+
+    parsed_json = json.loads(curr_gpt_response)
+    return parsed_json["output"]
 
 def GPT4_safe_generate_response(prompt, 
                                    example_output,
@@ -103,31 +212,40 @@ def ChatGPT_safe_generate_response(prompt,
                                    fail_safe_response="error",
                                    func_validate=None,
                                    func_clean_up=None,
-                                   verbose=False): 
+                                   verbose=False,
+                                   cache=True): 
     prompt = '"""\n' + prompt + '\n"""\n'
     prompt += f"Output the response to the prompt above in json. {special_instruction}\n"
     prompt += "Example output json:\n"
-    prompt += '{"output": "' + str(example_output) + '"}'
+    if isinstance(example_output, (dict, list)): 
+        # Structured outputs are shown as json values, not as a string. 
+        prompt += json.dumps({"output": example_output})
+    else: 
+        prompt += '{"output": "' + str(example_output) + '"}'
 
     if verbose: 
         print ("CHAT GPT PROMPT")
 
+    cache_key = None
+    if cache and llm_cache_enabled: 
+        cache_key = make_cache_key(llm_model, prompt, None)
+        cached_response = completion_cache.get_str(cache_key)
+        if cached_response is not None: 
+            try: 
+                output_content = extract_json_output(cached_response)
+                if func_validate(output_content, prompt=prompt): 
+                    return func_clean_up(output_content, prompt=prompt)
+            except Exception as e: 
+                if verbose: print(f"Cached response rejected: {e}")
+
     for i in range(repeat): 
         try: 
             curr_gpt_response = ChatGPT_request(prompt).strip()
-            
-            # --- 核心修复：自动补全缺失的右大括号 ---
-            if curr_gpt_response.count('{') > curr_gpt_response.count('}'):
-                curr_gpt_response += "}"
-
-            json_match = re.search(r'\{.*\}', curr_gpt_response, re.DOTALL)
-            if json_match:
-                curr_gpt_response = json_match.group()
-
-            parsed_json = json.loads(curr_gpt_response)
-            output_content = parsed_json["output"]
+            output_content = extract_json_output(curr_gpt_response)
             
             if func_validate(output_content, prompt=prompt): 
+                if cache_key: 
+                    completion_cache.put_str(cache_key, curr_gpt_response)
                 return func_clean_up(output_content, prompt=prompt)
         except Exception as e: 
             if verbose: print(f"Attempt {i} failed: {e}")
@@ -139,36 +257,21 @@ def ChatGPT_safe_generate_response(prompt,
 # ============================================================================
 
 def GPT_request(prompt, gpt_parameter): 
-    temp_sleep()
-    model = "deepseek-chat" 
-    try: 
-        response = openai.ChatCompletion.create(
-                model=model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=gpt_parameter["temperature"],
-                max_tokens=gpt_parameter["max_tokens"],
-                top_p=gpt_parameter["top_p"],
-                frequency_penalty=gpt_parameter["frequency_penalty"],
-                presence_penalty=gpt_parameter["presence_penalty"],
-                stop=gpt_parameter["stop"],)
-        return response.choices[0].message.content
-    except Exception as e: 
-        print (f"DeepSeek API 报错: {e}")
-        return "TOKEN LIMIT EXCEEDED"
+    return run_llm_coroutine(GPT_request_async(prompt, gpt_parameter))
+
+# Prompt templates are compiled once per file (and again when the file 
+# changes, while <prompt_template_hot_reload> is on). The hot reload costs a
+# stat call per rendered prompt, so it is only on in debug mode. 
+# prompt_registry.stats() reports how often each template was rendered; 
+# start_server prints it in debug mode. 
+prompt_template_hot_reload = debug
+prompt_registry = PromptTemplateRegistry(prompt_template_hot_reload)
 
 def generate_prompt(curr_input, prompt_lib_file): 
     if type(curr_input) == type("string"): 
         curr_input = [curr_input]
     curr_input = [str(i) for i in curr_input]
-
-    with open(prompt_lib_file, "r", encoding='utf-8') as f:
-        prompt = f.read()
-    
-    for count, i in enumerate(curr_input):   
-        prompt = prompt.replace(f"!<INPUT {count}>!", i)
-    if "<commentblockmarker>###</commentblockmarker>" in prompt: 
-        prompt = prompt.split("<commentblockmarker>###</commentblockmarker>")[1]
-    return prompt.strip()
+    return prompt_registry.render(prompt_lib_file, curr_input)
 
 def safe_generate_response(prompt, 
                            gpt_parameter,
@@ -176,11 +279,25 @@ def safe_generate_response(prompt,
                            fail_safe_response="error",
                            func_validate=None,
                            func_clean_up=None,
-                           verbose=False): 
+                           verbose=False,
+                           cache=True): 
+    cache_key = None
+    if cache and llm_cache_enabled: 
+        cache_key = make_cache_key(llm_model, prompt, gpt_parameter)
+        cached_response = completion_cache.get_str(cache_key)
+        if cached_response is not None: 
+            try:
+                if func_validate(cached_response, prompt=prompt): 
+                    return func_clean_up(cached_response, prompt=prompt)
+            except Exception as e:
+                if verbose: print(f"Cached response rejected: {e}")
+
     for i in range(repeat): 
         curr_gpt_response = GPT_request(prompt, gpt_parameter)
         try:
             if func_validate(curr_gpt_response, prompt=prompt): 
+                if cache_key and curr_gpt_response not in llm_error_responses: 
+                    completion_cache.put_str(cache_key, curr_gpt_response)
                 return func_clean_up(curr_gpt_response, prompt=prompt)
         except Exception as e:
             if verbose: print(f"Safe Generate Attempt {i} Error: {e}")
@@ -190,10 +307,141 @@ def safe_generate_response(prompt,
     return fail_safe_response
 
 # --- 本地向量部分保持不变 ---
-from sentence_transformers import SentenceTransformer
-embed_model = SentenceTransformer('paraphrase-MiniLM-L6-v2') 
+import numpy
+embed_model_name = 'paraphrase-MiniLM-L6-v2'
+embed_model = None
 
-def get_embedding(text, model=""):
-    text = text.replace("\n", " ")
+def get_embed_model(): 
+    """
+    Returns the SentenceTransformer for <embed_model_name>, loading it on 
+    first use. 
+    """
+    global embed_model
+    with _embed_model_lock: 
+        if embed_model is None: 
+            from sentence_transformers import SentenceTransformer
+            embed_model = SentenceTransformer(embed_model_name) 
+    return embed_model
+
+# Embedding cache. Embeddings are deterministic, so every text is only 
+# encoded once: the cache lives in <fs_temp_storage>, where all personas and
+# all forks of a simulation share it. Keys are the model name and the 
+# normalized text; values are the float32 bytes of the embedding. 
+embedding_cache_enabled = True
+embedding_cache_max_entries = 200000
+embedding_cache = DiskLRUCache(f"{fs_temp_storage}/embedding_cache.db",
+                               embedding_cache_max_entries)
+
+def normalize_embedding_text(text):
+    """
+    Collapses all whitespace (including newlines) to single spaces. The 
+    encoder's tokenizer splits on whitespace anyway, so this does not change
+    the embedding, but lets more texts share a cache entry. 
+    """
+    text = " ".join(text.split())
     if not text: text = "this is blank"
-    return embed_model.encode(text).tolist()
\ No newline at end of file
+    return text
+
+def get_embedding(text, model=""):
+    return get_embeddings([text], model)[0]
+
+def get_embeddings(texts, model=""):
+    """
+    Batched get_embedding: embeds all of <texts> with one encode call, which
+    is much cheaper than encoding them one by one. Texts found in the 
+    embedding cache are not encoded again. Returns a list of embeddings in 
+    the order of <texts>. 
+    """
+    texts = [normalize_embedding_text(text) for text in texts]
+    if not texts: 
+        return []
+
+    embeddings = [None] * len(texts)
+    if embedding_cache_enabled: 
+        for i, text in enumerate(texts): 
+            cached = embedding_cache.get(make_cache_key(embed_model_name, text))
+            if cached is not None: 
+                embeddings[i] = numpy.frombuffer(cached, 
+                                                 dtype=numpy.float32).tolist()
+
+    # Each distinct missing text is encoded once. 
+    missing = list(dict.fromkeys(texts[i] for i in range(len(texts)) 
+                                 if embeddings[i] is None))
+    if missing: 
+        encoded = dict()
+        for text, vec in zip(missing, get_embed_model().encode(missing)): 
+            vec = numpy.asarray(vec, dtype=numpy.float32)
+            encoded[text] = vec.tolist()
+            if embedding_cache_enabled: 
+                embedding_cache.put(make_cache_key(embed_model_name, text), 
+                                    vec.tobytes())
+        for i, text in enumerate(texts): 
+            if embeddings[i] is None: 
+                embeddings[i] = encoded[text]
+    return embeddings
+
+# Embedding micro-batching. Callers submit texts and get futures back; a 
+# background thread encodes everything that was submitted in one batch once
+# <embedding_batch_size> texts are waiting, or <embedding_batch_deadline> 
+# seconds after the first of them arrived. Submitting early (before the LLM
+# calls a step makes anyway) lets the texts of several events, thoughts or 
+# personas share one encode call. 
+embedding_batch_size = 64
+embedding_batch_deadline = 0.01
+
+class EmbeddingBatcher: 
+    def __init__(self, batch_size=embedding_batch_size, 
+                       deadline=embedding_batch_deadline): 
+        self.batch_size = batch_size
+        self.deadline = deadline
+        # <pending> holds the (text, future) pairs waiting to be encoded. 
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def submit(self, text): 
+        """
+        Queues <text> to be embedded. Returns a concurrent.futures.Future 
+        whose result is the embedding (as get_embedding returns it). 
+        """
+        future = concurrent.futures.Future()
+        with self.condition: 
+            if self.thread is None: 
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.pending.append((text, future))
+            if len(self.pending) in (1, self.batch_size): 
+                self.condition.notify()
+        return future
+
+    def _run(self): 
+        while True: 
+            with self.condition: 
+                while not self.pending: 
+                    self.condition.wait()
+                flush_at = time.time() + self.deadline
+                while len(self.pending) < self.batch_size: 
+                    remaining = flush_at - time.time()
+                    if remaining <= 0: 
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.batch_size]
+                self.pending = self.pending[self.batch_size:]
+
+            try: 
+                embeddings = get_embeddings([text for text, future in batch])
+            except Exception as e: 
+                for text, future in batch: 
+                    future.set_exception(e)
+                continue
+            for (text, future), embedding in zip(batch, embeddings): 
+                future.set_result(embedding)
+
+embedding_batcher = EmbeddingBatcher()
+
+def submit_embedding(text): 
+    """
+    Asynchronous get_embedding: returns a future of the embedding of <text>,
+    encoded in a batch with the other texts submitted around the same time. 
+    """
+    return embedding_batcher.submit(text)
@@ -6,6 +6,7 @@ Description: Defines all run gpt prompt functions. These functions directly
 interface with the safe_generate_response function.
 """
 import re
+import json
 import datetime
 import sys
 import ast
@@ -75,7 +76,8 @@ def run_gpt_prompt_wake_up_hour(persona, test_input=None, verbose=False):
   fail_safe = get_fail_safe()
 
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   cache=False)
   
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -147,7 +149,8 @@ def run_gpt_prompt_daily_plan(persona,
   fail_safe = get_fail_safe()
 
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   cache=False)
   output = ([f"wake up and complete the morning routine at {wake_up_hour}:00 am"]
               + output)
 
@@ -279,7 +282,8 @@ def run_gpt_prompt_generate_hourly_schedule(persona,
   fail_safe = get_fail_safe()
   
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   cache=False)
   
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -288,10 +292,190 @@ def run_gpt_prompt_generate_hourly_schedule(persona,
   return output, [output, prompt, gpt_param, prompt_input, fail_safe]
 
 
+def normalize_hour_str(hour): 
+  """
+  Makes hour strings comparable: "8:00 am" and "08:00 AM" are the same slot.
+  """
+  return hour.strip().upper().lstrip("0")
+
+
+def parse_hourly_activities(gpt_response, hour_str, firstname): 
+  """
+  Parses a json object that maps hours to activities (e.g., {"08:00 AM": 
+  "eating breakfast", ...}), as returned by the hourly schedule prompts. 
+
+  INPUT: 
+    gpt_response: The json object, or its string form. 
+    hour_str: The list of hour strings to read out (e.g., "08:00 AM"). 
+    firstname: The persona's first name, which is cut off a leading 
+               "<firstname> is ". 
+  OUTPUT: 
+    A list with one entry per <hour_str>: the activity of that hour, or None
+    if the response does not give one. 
+  """
+  if isinstance(gpt_response, str): 
+    gpt_response = json.loads(gpt_response)
+  by_hour = dict()
+  for hour, activity in gpt_response.items(): 
+    by_hour[normalize_hour_str(hour)] = activity
+
+  activities = []
+  for hour in hour_str: 
+    activity = by_hour.get(normalize_hour_str(hour))
+    if not isinstance(activity, str): 
+      activities += [None]
+      continue
+    activity = activity.strip()
+    if activity.startswith(f"{firstname} is "): 
+      activity = activity[len(f"{firstname} is "):]
+    if activity.endswith("."): 
+      activity = activity[:-1]
+    activities += [activity or None]
+  return activities
+
+
+def run_gpt_prompt_generate_full_day_schedule(persona, 
+                                              wake_up_hour, 
+                                              hour_str, 
+                                              test_input=None, 
+                                              verbose=False): 
+  """
+  Generates the activity of every waking hour of the day in one ChatGPT 
+  call, instead of one run_gpt_prompt_generate_hourly_schedule call per 
+  hour. 
+
+  OUTPUT: 
+    A list with one entry per <hour_str>: the activity (e.g., "eating 
+    breakfast") of that hour, or None for the hours before <wake_up_hour> 
+    and for the hours the response did not fill in. 
+  """
+  def create_prompt_input(persona, wake_up_hour, hour_str, test_input=None): 
+    if test_input: return test_input
+    intermission_str = f"Here the originally intended hourly breakdown of"
+    intermission_str += f" {persona.scratch.get_str_firstname()}'s schedule today: "
+    for count, i in enumerate(persona.scratch.daily_req): 
+      intermission_str += f"{str(count+1)}) {i}, "
+    intermission_str = intermission_str[:-2]
+
+    prompt_input = []
+    prompt_input += [persona.scratch.get_str_iss()]
+    prompt_input += [intermission_str]
+    prompt_input += [persona.scratch.get_str_firstname()]
+    prompt_input += [persona.scratch.get_str_curr_date_str()]
+    prompt_input += [", ".join(hour_str[wake_up_hour:])]
+    return prompt_input
+
+  def __chat_func_clean_up(gpt_response, prompt=""): 
+    activities = parse_hourly_activities(
+      gpt_response, hour_str, persona.scratch.get_str_firstname())
+    return [None] * wake_up_hour + activities[wake_up_hour:]
+
+  def __chat_func_validate(gpt_response, prompt=""): 
+    try: 
+      activities = __chat_func_clean_up(gpt_response, prompt)
+    except: 
+      return False
+    return any(activities)
+
+  def get_fail_safe(): 
+    return [None] * len(hour_str)
+
+  gpt_param = {"engine": "text-davinci-002", "max_tokens": 800, 
+               "temperature": 0.5, "top_p": 1, "stream": False,
+               "frequency_penalty": 0, "presence_penalty": 0, "stop": None}
+  prompt_template = "persona/prompt_template/v3_ChatGPT/generate_hourly_schedule_v3.txt"
+  prompt_input = create_prompt_input(persona, wake_up_hour, hour_str, 
+                                     test_input)
+  prompt = generate_prompt(prompt_input, prompt_template)
+  example_output = {"07:00 AM": "waking up and getting ready for the day", 
+                    "08:00 AM": "eating breakfast at home", 
+                    "09:00 AM": "working on her painting"}
+  special_instruction = ("The value of \"output\" must be a json object that "
+                         "maps every hour listed above (in the same format, "
+                         "e.g., \"09:00 AM\") to the activity of that hour.")
+  fail_safe = get_fail_safe()
+  output = ChatGPT_safe_generate_response(prompt, example_output, 
+                                          special_instruction, 3, fail_safe,
+                                          __chat_func_validate, 
+                                          __chat_func_clean_up, 
+                                          cache=False)
+  if output == False: 
+    output = fail_safe
+
+  if debug or verbose: 
+    print_run_prompts(prompt_template, persona, gpt_param, 
+                      prompt_input, prompt, output)
+
+  return output, [output, prompt, gpt_param, prompt_input, fail_safe]
+
+
+def run_gpt_prompt_revise_hourly_schedule(persona, 
+                                          prev_activities, 
+                                          hour_str, 
+                                          test_input=None, 
+                                          verbose=False): 
+  """
+  Revises yesterday's hourly schedule for today in one ChatGPT call: the 
+  response only names the hours that change. 
+
+  OUTPUT: 
+    A list with one entry per <hour_str>: the new activity of that hour, or 
+    None for the hours that stay as they were in <prev_activities>. 
+  """
+  def create_prompt_input(persona, prev_activities, hour_str, 
+                          test_input=None): 
+    if test_input: return test_input
+    prev_schedule_str = ""
+    for curr_hour_str, activity in zip(hour_str, prev_activities): 
+      prev_schedule_str += f"{curr_hour_str}: {activity}\n"
+
+    prompt_input = []
+    prompt_input += [persona.scratch.get_str_iss()]
+    prompt_input += [persona.scratch.get_str_firstname()]
+    prompt_input += [prev_schedule_str.strip()]
+    prompt_input += [persona.scratch.get_str_curr_date_str()]
+    return prompt_input
+
+  def __chat_func_clean_up(gpt_response, prompt=""): 
+    return parse_hourly_activities(gpt_response, hour_str, 
+                                   persona.scratch.get_str_firstname())
+
+  def __chat_func_validate(gpt_response, prompt=""): 
+    try: 
+      __chat_func_clean_up(gpt_response, prompt)
+    except: 
+      return False
+    return True
 
+  def get_fail_safe(): 
+    return [None] * len(hour_str)
 
+  gpt_param = {"engine": "text-davinci-002", "max_tokens": 400, 
+               "temperature": 0.5, "top_p": 1, "stream": False,
+               "frequency_penalty": 0, "presence_penalty": 0, "stop": None}
+  prompt_template = "persona/prompt_template/v3_ChatGPT/revise_hourly_schedule_v1.txt"
+  prompt_input = create_prompt_input(persona, prev_activities, hour_str, 
+                                     test_input)
+  prompt = generate_prompt(prompt_input, prompt_template)
+  example_output = {"09:00 AM": "visiting the library to return a book"}
+  special_instruction = ("The value of \"output\" must be a json object that "
+                         "maps each hour that changes (in the same format, "
+                         "e.g., \"09:00 AM\") to its new activity. It can be "
+                         "an empty json object.")
+  fail_safe = get_fail_safe()
+  output = ChatGPT_safe_generate_response(prompt, example_output, 
+                                          special_instruction, 3, fail_safe,
+                                          __chat_func_validate, 
+                                          __chat_func_clean_up, 
+                                          cache=False)
+  if output == False: 
+    output = fail_safe
 
+  if debug or verbose: 
+    print_run_prompts(prompt_template, persona, gpt_param, 
+                      prompt_input, prompt, output)
 
+  return output, [output, prompt, gpt_param, prompt_input, fail_safe]
 
 
 def run_gpt_prompt_task_decomp(persona, 
@@ -771,7 +955,7 @@ def run_gpt_prompt_action_game_object(action_description,
 
   x = [i.strip() for i in persona.s_mem.get_str_accessible_arena_game_objects(temp_address).split(",")]
   if output not in x: 
-    output = random.choice(x)
+    output = persona.rng.choice(x)
 
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -1571,7 +1755,8 @@ def run_gpt_prompt_create_conversation(persona, target_persona, curr_loc,
 
   fail_safe = get_fail_safe(persona, target_persona)
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   cache=False)
 
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -1750,7 +1935,8 @@ def run_gpt_prompt_keyword_to_thoughts(persona, keyword, concept_summary, test_i
 
   fail_safe = get_fail_safe()
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   cache=False)
 
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -1808,7 +1994,8 @@ def run_gpt_prompt_convo_to_thoughts(persona,
 
   fail_safe = get_fail_safe()
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   cache=False)
 
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -2178,7 +2365,8 @@ def run_gpt_prompt_insight_and_guidance(persona, statements, n, test_input=None,
 
   fail_safe = get_fail_safe(n)
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   cache=False)
 
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -2602,7 +2790,8 @@ def run_gpt_prompt_generate_next_convo_line(persona, interlocutor_desc, prev_con
 
   fail_safe = get_fail_safe()
   output = safe_generate_response(prompt, gpt_param, 5, fail_safe,
-                                   __func_validate, __func_clean_up)
+                                   __func_validate, __func_clean_up,
+                                   cache=False)
 
   if debug or verbose: 
     print_run_prompts(prompt_template, persona, gpt_param, 
@@ -13,6 +13,7 @@ import shutil
 import traceback
 import sys
 import io
+from concurrent.futures import ThreadPoolExecutor
 
 print(f"CRITICAL DEBUG: The API Key being used is: {os.getenv('OPENAI_API_KEY')}")
 
@@ -20,7 +21,6 @@ print(f"CRITICAL DEBUG: The API Key being used is: {os.getenv('OPENAI_API_KEY')}
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
-from selenium import webdriver
 from global_methods import *
 from utils import *
 from maze import *
@@ -61,7 +61,7 @@ class ReverieServer:
       persona_folder = f"{sim_folder}/personas/{persona_name}"
       p_x = init_env[persona_name]["x"]
       p_y = init_env[persona_name]["y"]
-      curr_persona = Persona(persona_name, persona_folder)
+      curr_persona = Persona(persona_name, persona_folder, self.curr_time)
 
       self.personas[persona_name] = curr_persona
       self.personas_tile[persona_name] = (p_x, p_y)
@@ -69,6 +69,30 @@ class ReverieServer:
 
     self.server_sleep = 0.1
 
+    # <step_mode> decides how the personas' cognitive sequences are run in a
+    # step. "serial" moves one persona after another. "threads" runs the 
+    # groups from get_interaction_groups() concurrently on a thread pool, so
+    # that their LLM requests are in flight together on the async LLM client
+    # (see gpt_structure.get_llm_loop). Both write the same movement files. 
+    self.step_mode = "serial"
+    # <step_workers> is the number of worker threads for the "threads" mode.
+    # None means one per persona. 
+    self.step_workers = None
+    self.step_executor = None
+    # With <fast_forward>, the personas whose state would not change in a 
+    # step (see Persona.can_fast_forward), e.g., while asleep or walking 
+    # along their path, skip their cognitive sequence, and only their 
+    # position and time are advanced. 
+    self.fast_forward = True
+    # <fast_forwarded> holds the names of the personas fast-forwarded in the
+    # last step. 
+    self.fast_forwarded = set()
+    # With <checkpoint_every_step>, the personas' scratch and the meta are 
+    # saved after every step (see checkpoint), so that a crash loses at most
+    # the step that was running. Otherwise the server resumes from the last
+    # save, and the nodes journaled since then are dropped. 
+    self.checkpoint_every_step = True
+
     curr_sim_code = {"sim_code": self.sim_code}
     with open(f"{fs_temp_storage}/curr_sim_code.json", "w") as outfile: 
       outfile.write(json.dumps(curr_sim_code, indent=2))
@@ -77,7 +101,24 @@ class ReverieServer:
     with open(f"{fs_temp_storage}/curr_step.json", "w") as outfile: 
       outfile.write(json.dumps(curr_step, indent=2))
 
-  def save(self): 
+  def save(self, compact=False): 
+    """
+    Saves the simulation meta and all personas' states. Associative memories
+    journal their nodes as they are created, so by default only the journal
+    is kept; <compact> folds it into a fresh snapshot. 
+    """
+    sim_folder = f"{fs_storage}/{self.sim_code}"
+    self.save_meta()
+
+    for persona_name, persona in self.personas.items(): 
+      save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
+      persona.save(save_folder, compact)
+
+  def save_meta(self): 
+    """
+    Saves the simulation meta (reverie/meta.json). Its <curr_time> is the 
+    time the simulation resumes at when it is loaded again. 
+    """
     sim_folder = f"{fs_storage}/{self.sim_code}"
     reverie_meta = {
         "fork_sim_code": self.fork_sim_code,
@@ -88,12 +129,165 @@ class ReverieServer:
         "persona_names": list(self.personas.keys()),
         "step": self.step
     }
-    with open(f"{sim_folder}/reverie/meta.json", "w") as outfile: 
+    meta_file = f"{sim_folder}/reverie/meta.json"
+    with open(meta_file + ".tmp", "w") as outfile: 
       outfile.write(json.dumps(reverie_meta, indent=2))
+    os.replace(meta_file + ".tmp", meta_file)
 
+  def checkpoint(self): 
+    """
+    Saves what has to match the associative memory journals after a step: 
+    every persona's scratch, and then the meta. The journals already hold 
+    the step's nodes, and the spatial memories are only saved by save(), 
+    since they are rebuilt by perceiving. 
+    """
+    sim_folder = f"{fs_storage}/{self.sim_code}"
     for persona_name, persona in self.personas.items(): 
-      save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
-      persona.save(save_folder)
+      persona.scratch.save(
+        f"{sim_folder}/personas/{persona_name}/bootstrap_memory/scratch.json")
+    self.save_meta()
+
+  def get_interaction_groups(self): 
+    """
+    Splits the personas into groups that cannot affect each other during the
+    current step. Two personas end up in the same group if one is within the
+    other's vision radius (so that one may perceive or react to the other), 
+    or if one is already engaged with the other (chatting with them, or 
+    heading to them with a "<persona>" action address). 
+
+    OUTPUT: 
+      A list of lists of persona names. Each group keeps the order of 
+      self.personas, and the groups are ordered by their first persona. 
+    """
+    names = list(self.personas.keys())
+    parent = {name: name for name in names}
+
+    def find(name): 
+      while parent[name] != name: 
+        parent[name] = parent[parent[name]]
+        name = parent[name]
+      return name
+
+    for name_a in names: 
+      scratch_a = self.personas[name_a].scratch
+      x_a, y_a = self.personas_tile[name_a]
+      engaged = [scratch_a.chatting_with]
+      if scratch_a.act_address and "<persona>" in scratch_a.act_address: 
+        engaged += [scratch_a.act_address.split("<persona>")[-1].strip()]
+
+      for name_b in names: 
+        if name_a == name_b: 
+          continue
+        x_b, y_b = self.personas_tile[name_b]
+        if ((abs(x_a - x_b) <= scratch_a.vision_r 
+             and abs(y_a - y_b) <= scratch_a.vision_r)
+            or name_b in engaged): 
+          parent[find(name_b)] = find(name_a)
+
+    groups = dict()
+    for name in names: 
+      groups.setdefault(find(name), []).append(name)
+    return list(groups.values())
+
+
+  def get_step_executor(self): 
+    """
+    Returns the thread pool used by the "threads" step mode, (re)creating
+    it if <step_workers> changed since it was built. 
+    """
+    n_workers = self.step_workers or max(1, len(self.personas))
+    if (not self.step_executor 
+        or self.step_executor._max_workers != n_workers): 
+      if self.step_executor: 
+        self.step_executor.shutdown(wait=True)
+      self.step_executor = ThreadPoolExecutor(max_workers=n_workers)
+    return self.step_executor
+
+
+  def move_persona(self, persona_name): 
+    """
+    Moves one persona for the current step. With <fast_forward>, a persona 
+    whose state would not change (see Persona.can_fast_forward) is only 
+    advanced. That is decided at the persona's turn, so a persona engaged 
+    earlier in the step (e.g., another persona started a chat with it) gets 
+    its full cognitive sequence. 
+
+    INPUT: 
+      persona_name: the name of the persona to move. 
+    OUTPUT: 
+      The execution triple (see Persona.move). 
+    """
+    persona = self.personas[persona_name]
+    curr_tile = self.personas_tile[persona_name]
+    nearby_tiles = None
+    if self.fast_forward: 
+      nearby_tiles = self.maze.get_nearby_tiles(curr_tile, 
+                                                persona.scratch.vision_r)
+      if persona.can_fast_forward(self.maze, curr_tile, self.curr_time, 
+                                  nearby_tiles): 
+        self.fast_forwarded.add(persona_name)
+        return persona.fast_forward(self.maze, self.personas, curr_tile, 
+                                    self.curr_time, nearby_tiles)
+
+    print(f"正在计算角色行动: {persona_name}...")
+    return persona.move(self.maze, self.personas, curr_tile, self.curr_time, 
+                        nearby_tiles)
+
+
+  def move_group(self, group): 
+    """
+    Runs the cognitive sequences of the personas in <group> one after 
+    another, in the same order as the serial loop. 
+
+    INPUT: 
+      group: a list of persona names. 
+    OUTPUT: 
+      A dictionary of persona name -> execution triple (see Persona.move). 
+    """
+    executions = dict()
+    for persona_name in group: 
+      executions[persona_name] = self.move_persona(persona_name)
+    return executions
+
+
+  def move_personas(self): 
+    """
+    Runs one step of all personas' cognitive sequences according to 
+    <step_mode>. 
+
+    In the "threads" mode, the interaction groups are computed once from 
+    the state at the start of the step. During move() a persona only writes
+    to its own scratch and memories (and to the scratch of the personas it 
+    starts chatting with, who are in its group), and only reads the maze and
+    the personas it can perceive, who are also in its group. The results do
+    not depend on how the groups are scheduled, and they are merged by 
+    persona name. check_step_modes.py compares both modes with a stub LLM. 
+
+    This only holds while the shared structures stay read only during the 
+    step: the maze's tiles and their events (start_server updates them 
+    between steps), self.personas and self.personas_tile. The shared caches
+    that are filled during a step are locked, and their contents do not 
+    depend on who fills them first: Maze.distance_fields, the completion 
+    and embedding caches, and the prompt registry (see gpt_structure). 
+
+    OUTPUT: 
+      A dictionary of persona name -> execution triple (see Persona.move), 
+      in the order of self.personas. 
+    """
+    self.fast_forwarded = set()
+    if self.step_mode == "threads": 
+      executor = self.get_step_executor()
+      futures = [executor.submit(self.move_group, group) 
+                 for group in self.get_interaction_groups()]
+      executions = dict()
+      for future in futures: 
+        executions.update(future.result())
+    else: 
+      executions = self.move_group(list(self.personas.keys()))
+
+    return {persona_name: executions[persona_name] 
+            for persona_name in self.personas}
+
 
   def start_server(self, int_counter): 
     sim_folder = f"{fs_storage}/{self.sim_code}"
@@ -138,10 +332,9 @@ class ReverieServer:
 
             # 核心大脑决策
             movements = {"persona": dict(), "meta": dict()}
+            executions = self.move_personas()
             for persona_name, persona in self.personas.items(): 
-              print(f"正在计算角色行动: {persona_name}...")
-              next_tile, pronunciatio, description = persona.move(
-                self.maze, self.personas, self.personas_tile[persona_name], self.curr_time)
+              next_tile, pronunciatio, description = executions[persona_name]
               
               movements["persona"][persona_name] = {
                 "movement": next_tile,
@@ -161,6 +354,13 @@ class ReverieServer:
             self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
             int_counter -= 1
             print(f"完成第 {self.step-1} 步。")
+            if self.checkpoint_every_step: 
+              self.checkpoint()
+
+            # When every persona was fast-forwarded (e.g., at night), the 
+            # next environment file is looked for right away. 
+            if len(self.fast_forwarded) == len(self.personas): 
+              continue
             
           except Exception as e:
             print("!!! 后端运行逻辑崩溃 !!!")
@@ -169,6 +369,10 @@ class ReverieServer:
 
       time.sleep(self.server_sleep)
 
+    if debug: 
+      print ("LLM completion cache:", completion_cache.stats())
+      print ("Prompt template renders:", prompt_registry.stats())
+
   def open_server(self): 
     print ("--- 后端服务已启动 ---")
     sim_folder = f"{fs_storage}/{self.sim_code}"
@@ -177,7 +381,7 @@ class ReverieServer:
       sim_command = input("Enter option: ").strip()
       try: 
         if sim_command.lower() in ["f", "fin", "save and finish"]: 
-          self.save(); break
+          self.save(compact=True); break
         elif sim_command.lower() == "exit": 
           shutil.rmtree(sim_folder); break 
         elif sim_command.lower() == "save": 